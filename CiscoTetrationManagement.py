@@ -2,10 +2,38 @@
 """Cisco Tetration Analytics Python script."""
 
 import argparse
+import array
+import contextlib
+import copy
+import cProfile
 import json
 import csv
+import errno
+import glob
+import hashlib
+import itertools
+import os
+import Queue
+import random
+import re
+import socket
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import requests
 from tetpyclient import RestClient
-from termcolor import colored
+from termcolor import colored as termcolor_colored
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import resource
+except ImportError:
+    resource = None
 
 __author__ = "Larry Smith Jr."
 __email___ = "mrlesmithjr@gmail.com"
@@ -33,6 +61,12 @@ python CiscoTetrationManagement.py get_app_scope \
 --apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
 --appscopeid 599f4f35755f0237896ce9cf
 
+View the application scope tree below a scope
+---------------------------------------------
+python CiscoTetrationManagement.py get_app_scope_tree \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--appscopeshortname "Default:Prod"
+
 View applications
 -----------------
 python CiscoTetrationManagement.py get_apps \
@@ -64,12 +98,129 @@ python CiscoTetrationManagement.py create_app \
 --appname "Test App" --appdescription "Test App Using API" \
 --appscopeprimary False --appscopeshortname "xxxxx"
 
+Export user role memberships as CSV for an access review
+--------------------------------------------------------
+python CiscoTetrationManagement.py get_role_members \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--output csv > memberships.csv
+
+View users holding any of several roles, or roles without members
+-----------------------------------------------------------------
+python CiscoTetrationManagement.py get_role_members \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--roles "Scope Owners,Site Admins" --match any
+
+python CiscoTetrationManagement.py get_role_members \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--emptyroles
+
+View sensor and switch counts and members per VRF
+-------------------------------------------------
+python CiscoTetrationManagement.py get_vrf_inventory \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--output table
+
 View an application clusters
 ----------------------------
 python CiscoTetrationManagement.py get_app_clusters \
 --apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
 --appid 59cdc1e7755f0225066ce9d4
 
+View clusters for many applications concurrently
+------------------------------------------------
+python CiscoTetrationManagement.py get_app_clusters \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--appids 59cdc1e7755f0225066ce9d4,59cdc1e7755f0225066ce9d5 \
+--savetofile clusters.ndjson
+
+View clusters for all applications in an application scope
+----------------------------------------------------------
+python CiscoTetrationManagement.py get_app_clusters \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--appscopeid 599f4f35755f0237896ce9cf --savetofile clusters.ndjson
+
+View sensors across many Tetration clusters concurrently
+--------------------------------------------------------
+python CiscoTetrationManagement.py get_sensors \
+--clustersfile clusters.json --savetofile sensors.json
+
+clusters.json lists each cluster to query:
+[{"name": "dc1", "apiendpoint": "https://172.16.5.4",
+  "credsfile": "dc1_credentials.json"}, ...]
+
+View sensors as a compact table
+------------------------------
+python CiscoTetrationManagement.py get_sensors \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--output table --columns host_name,platform,current_sw_version
+
+Stream sensors into jq as one JSON record per line
+--------------------------------------------------
+python CiscoTetrationManagement.py get_sensors \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--output ndjson | jq -r .host_name
+
+View flow dimensions bypassing the persistent HTTP cache
+--------------------------------------------------------
+python CiscoTetrationManagement.py get_flow_dimensions \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--no-cache
+
+Diff application clusters between two runs
+------------------------------------------
+python CiscoTetrationManagement.py diff_app_clusters \
+--difffiles clusters-old.ndjson clusters-new.ndjson
+
+Sensor fleet check-in age, version and platform statistics
+----------------------------------------------------------
+python CiscoTetrationManagement.py sensor_stats \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--output table
+
+Clean up sensors not seen for 30 days and duplicate registrations
+-----------------------------------------------------------------
+python CiscoTetrationManagement.py cleanup_sensors \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--staledays 30 --duplicates --ratelimit 5 --dryrun --output table
+
+Preview how many inventory items new application scopes would match
+-------------------------------------------------------------------
+python CiscoTetrationManagement.py preview_app_scopes \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--readcsv scopes.csv
+
+Profile a bulk run
+------------------
+python CiscoTetrationManagement.py add_users \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--readcsv users.csv --profile add_users.pstats
+
+Trace every API call of a bulk run (open in chrome://tracing or Perfetto)
+------------------------------------------------------------------------
+python CiscoTetrationManagement.py add_user_roles \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--readcsv roles.csv --trace add_user_roles.trace.json
+
+Bound how long a bulk run can hang on a slow or failing cluster
+---------------------------------------------------------------
+python CiscoTetrationManagement.py add_users \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--readcsv users.csv --connecttimeout 3 --readtimeout 15 --retries 2
+
+Mirror tenant objects into a local SQLite file
+----------------------------------------------
+python CiscoTetrationManagement.py sync \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--dbfile tetration.db
+
+Query the local mirror without calling the API
+----------------------------------------------
+python CiscoTetrationManagement.py query --dbfile tetration.db \
+--queryname role_users --userrole "Scope Owners"
+
+python CiscoTetrationManagement.py query --dbfile tetration.db \
+--sql "SELECT platform, COUNT(*) AS sensors FROM sensors GROUP BY platform"
+
 Delete an application
 ---------------------
 python CiscoTetrationManagement.py delete_app \
@@ -82,12 +233,46 @@ python CiscoTetrationManagement.py add_users \
 --apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
 --readcsv users.csv
 
+Create users with CSV file as input and a resumable journal
+-----------------------------------------------------------
+python CiscoTetrationManagement.py add_users \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--readcsv users.csv --journal users.journal
+
+Benchmark sensor record memory against the API dicts
+----------------------------------------------------
+python CiscoTetrationManagement.py bench_sensor_memory --benchcount 100000
+
+Create users with CSV file as input using the staged bulk pipeline
+------------------------------------------------------------------
+python CiscoTetrationManagement.py add_users \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--readcsv users.csv --pipeline --workers 16
+
+Validate a bulk CSV without making any changes
+----------------------------------------------
+python CiscoTetrationManagement.py create_app_scope \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--readcsv scopes.csv --validateonly
+
 Get a sensor
 ------------
 python CiscoTetrationManagement.py get_sensor \
 --apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
 --hostname server001
 
+View which sensors have an interface in each subnet
+---------------------------------------------------
+python CiscoTetrationManagement.py match_sensor_subnets \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--subnetsfile subnets.txt
+
+Watch sensors for changes, writing one JSON line per change
+-----------------------------------------------------------
+python CiscoTetrationManagement.py watch \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--interval 300
+
 Delete a sensor
 ---------------
 python CiscoTetrationManagement.py delete_sensor \
@@ -98,24 +283,1367 @@ View VRFs
 ---------
 python CiscoTetrationManagement.py get_vrfs \
 --apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+
+View an inventory filter by name within an application scope
+-------------------------------------------------------------
+python CiscoTetrationManagement.py get_inventory_filter \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--filtername "Web Servers" --appscopeid 599f4f35755f0237896ce9cf
+
+Create inventory filters with CSV file as input
+-----------------------------------------------
+python CiscoTetrationManagement.py create_inventory_filters \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--readcsv filters.csv --workers 16
+
+Add and remove many user role memberships with CSV file as input
+----------------------------------------------------------------
+python CiscoTetrationManagement.py update_user_roles \
+--apiendpoint https://172.16.5.4 --credsfile api_credentials.json \
+--readcsv memberships.csv --workers 16
+
+memberships.csv has a header row and then rows of email,role,add|remove
+"""
+
+
+# Actions which work on local files only and never call the API.
+OFFLINE_ACTIONS = ['bench_sensor_memory', 'diff_app_clusters', 'query']
+
+# Actions which need numpy to be installed.
+NUMPY_ACTIONS = ['match_sensor_subnets', 'preview_app_scopes',
+                 'sensor_stats']
+
+# Bulk CSV actions validated by a pre-flight pass before any mutation.
+PREFLIGHT_ACTIONS = ['add_user_roles', 'add_users', 'create_app_scope',
+                     'create_inventory_filters', 'delete_users',
+                     'update_user_roles']
+
+# Abilities which can be granted to a role on an application scope.
+ROLE_ABILITIES = ['SCOPE_READ', 'SCOPE_WRITE', 'EXECUTE', 'DEVELOPER',
+                  'SCOPE_OWNER']
+
+# Read actions which can be run against many clusters with --clustersfile.
+FANOUT_ENDPOINTS = {
+    'get_app_scopes': '/app_scopes',
+    'get_apps': '/applications',
+    'get_inventory_filters': '/filters/inventories',
+    'get_sensors': '/sensors',
+    'get_switches': '/switches',
+    'get_user_roles': '/roles',
+    'get_users': '/users',
+    'get_vrfs': '/vrfs'
+}
+
+
+# API collections used to scope cache invalidation, longest paths first.
+COLLECTIONS = ['/filters/inventories', '/app_scopes', '/applications',
+               '/roles', '/sensors', '/switches', '/users', '/vrfs']
+
+# Mutations below a collection which change every item in it.
+COLLECTION_WIDE_MUTATIONS = ['/app_scopes/commit_dirty']
+
+# Near-static endpoints persisted in the on-disk cache, with TTLs in seconds.
+DISK_CACHE_TTLS = {
+    '/flowsearch/dimensions': 86400,
+    '/flowsearch/metrics': 86400,
+    '/inventory/search/dimensions': 86400,
+    '/switches': 3600,
+    '/vrfs': 3600
+}
+
+# Read timeouts in seconds of collections slower than --readtimeout.
+ENDPOINT_READ_TIMEOUTS = {
+    '/applications': 60,
+    '/flowsearch': 120,
+    '/inventory': 120,
+    '/sensors': 120
+}
+
+# Statuses worth retrying, and the backoff base and cap in seconds.
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 10
+
+# Consecutive failures which open the circuit of a collection, and the
+# seconds requests to it then fail fast before a trial request is let
+# through.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 30
+
+# Sensor fields which change on every check-in and are ignored by watch.
+WATCH_VOLATILE_FIELDS = ['last_config_fetch_at']
+
+# Collections each in-memory index in Tetration.cache is built from.
+INDEX_COLLECTIONS = {
+    'apps': '/applications',
+    'filters': '/filters/inventories',
+    'roles': '/roles',
+    'scopes': '/app_scopes',
+    'sensors': '/sensors',
+    'users': '/users'
+}
+
+# Tables of the sync mirror: table -> (endpoint, id field, indexed fields).
+MIRROR_TABLES = {
+    'apps': ('/applications', 'id', ['name', 'app_scope_id']),
+    'filters': ('/filters/inventories', 'id', ['name', 'app_scope_id']),
+    'roles': ('/roles', 'id', ['name', 'app_scope_id']),
+    'scopes': ('/app_scopes', 'id', ['name', 'short_name',
+                                     'parent_app_scope_id']),
+    'sensors': ('/sensors', 'uuid', ['host_name', 'platform',
+                                     'current_sw_version',
+                                     'last_config_fetch_at']),
+    'users': ('/users', 'id', ['email', 'first_name', 'last_name']),
+    'vrfs': ('/vrfs', 'id', ['name', 'tenant_id'])
+}
+
+# Link tables of the sync mirror, filled from list fields of their parent.
+MIRROR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_roles (user_id TEXT, role_id TEXT);
+CREATE INDEX IF NOT EXISTS user_roles_user_id ON user_roles (user_id);
+CREATE INDEX IF NOT EXISTS user_roles_role_id ON user_roles (role_id);
+CREATE TABLE IF NOT EXISTS sensor_ips (uuid TEXT, ip TEXT, vrf_id INTEGER);
+CREATE INDEX IF NOT EXISTS sensor_ips_uuid ON sensor_ips (uuid);
+CREATE INDEX IF NOT EXISTS sensor_ips_ip ON sensor_ips (ip);
+CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, synced_at REAL,
+                                       records INTEGER);
 """
 
+# Named lookups of the query action: name -> (SQL, arguments for :value).
+MIRROR_QUERIES = {
+    'app_scope_apps': (
+        'SELECT apps.data FROM apps '
+        'JOIN scopes ON scopes.id = apps.app_scope_id '
+        'WHERE scopes.id = :value OR scopes.name = :value '
+        'OR scopes.short_name = :value ORDER BY apps.name',
+        ['appscopeid', 'appscopeshortname']),
+    'app_scope_children': (
+        'SELECT children.data FROM scopes AS children '
+        'JOIN scopes ON scopes.id = children.parent_app_scope_id '
+        'WHERE scopes.id = :value OR scopes.name = :value '
+        'OR scopes.short_name = :value ORDER BY children.name',
+        ['appscopeid', 'appscopeshortname']),
+    'app_scope_filters': (
+        'SELECT filters.data FROM filters '
+        'JOIN scopes ON scopes.id = filters.app_scope_id '
+        'WHERE scopes.id = :value OR scopes.name = :value '
+        'OR scopes.short_name = :value ORDER BY filters.name',
+        ['appscopeid', 'appscopeshortname']),
+    'host_sensors': (
+        'SELECT data FROM sensors WHERE host_name = :value',
+        ['hostname']),
+    'ip_sensors': (
+        'SELECT DISTINCT sensors.data FROM sensors '
+        'JOIN sensor_ips ON sensor_ips.uuid = sensors.id '
+        'WHERE sensor_ips.ip = :value',
+        ['ip']),
+    'role_users': (
+        'SELECT users.data FROM users '
+        'JOIN user_roles ON user_roles.user_id = users.id '
+        'JOIN roles ON roles.id = user_roles.role_id '
+        'WHERE roles.name = :value OR roles.id = :value ORDER BY users.email',
+        ['userrole']),
+    'user_roles': (
+        'SELECT roles.data FROM roles '
+        'JOIN user_roles ON user_roles.role_id = roles.id '
+        'JOIN users ON users.id = user_roles.user_id '
+        'WHERE users.email = :value ORDER BY roles.name',
+        ['useremail'])
+}
+
+# Phases reported by --profile, in order.
+PROFILE_PHASES = ['auth', 'fetch', 'parse', 'mutate', 'output']
+
+# getrusage() target for the calling thread on Linux.
+RUSAGE_THREAD = 1
+
+# Path segments which are object ids, collapsed in trace endpoint names.
+TRACE_ID_SEGMENT = re.compile(r'^([0-9a-f]{24}|[0-9a-f]{40}|'
+                              r'[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}|'
+                              r'\d+)$')
+
+# Categorical /sensors fields counted by sensor_stats.
+SENSOR_STATS_FIELDS = ['platform', 'current_sw_version', 'agent_type']
+
+# Age percentiles and histogram buckets (upper bounds in seconds) reported
+# by sensor_stats.
+SENSOR_STATS_PERCENTILES = [50, 90, 95, 99, 100]
+SENSOR_AGE_BUCKETS = [('<1h', 3600), ('1h-1d', 86400), ('1d-7d', 604800),
+                      ('7d-30d', 2592000), ('30d-90d', 7776000),
+                      ('>90d', None)]
+
+# Records sampled to size table columns, and the widest a column may grow.
+TABLE_SAMPLE_ROWS = 100
+TABLE_MAX_WIDTH = 40
+
+
+class TetrationError(Exception):
+    """Raised when the API does not return a usable response."""
+
+
+class CircuitOpenError(TetrationError):
+    """Raised instead of sending a request to a collection failing fast."""
+
+
+class Pipeline(object):
+    """
+    Staged bulk pipeline.
+
+    Every stage runs in its own worker threads and hands items to the next
+    stage through a bounded queue, so reading and validating rows runs
+    ahead of the network stages. A stage function returns the list of items
+    to pass on, so a stage can drop items or split a chunk into single
+    items. Throughput, utilization and queue depth of each
+    stage are reported on stderr every report_interval seconds and at the
+    end, which shows where a run is bottlenecked.
+    """
+
+    DONE = object()
+
+    def __init__(self, stages, queue_size=1000, report_interval=5):
+        """Setup from a list of (name, func, workers) stages."""
+        self.stages = stages
+        self.queues = [Queue.Queue(queue_size) for _ in range(len(stages) + 1)]
+        self.stats = [{"name": name, "items": 0, "errors": 0, "busy": 0.0,
+                       "max_depth": 0, "finished": 0}
+                      for name, _func, _workers in stages]
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        self.start = None
+
+    def run(self, source, sink):
+        """Feed items from source through the stages into sink."""
+        self.start = time.time()
+        for i, (_name, _func, workers) in enumerate(self.stages):
+            for _ in range(workers):
+                thread = threading.Thread(target=self.work, args=(i,))
+                thread.daemon = True
+                thread.start()
+        feeder = threading.Thread(target=self.feed, args=(source,))
+        feeder.daemon = True
+        feeder.start()
+        last_report = time.time()
+        while True:
+            try:
+                item = self.queues[-1].get(timeout=self.report_interval)
+            except Queue.Empty:
+                item = None
+            if item is self.DONE:
+                break
+            if item is not None:
+                sink(item)
+            if time.time() - last_report >= self.report_interval:
+                self.report()
+                last_report = time.time()
+        self.report()
+
+    def feed(self, source):
+        """Put every source item on the first queue."""
+        for item in source:
+            self.queues[0].put(item)
+        for _ in range(self.stages[0][2]):
+            self.queues[0].put(self.DONE)
+
+    def work(self, i):
+        """Run stage i until its input is exhausted."""
+        name, func, _workers = self.stages[i]
+        stats = self.stats[i]
+        while True:
+            depth = self.queues[i].qsize()
+            if depth > stats['max_depth']:
+                stats['max_depth'] = depth
+            item = self.queues[i].get()
+            if item is self.DONE:
+                break
+            start = time.time()
+            try:
+                items = func(item)
+            except Exception as err:  # pylint: disable=broad-except
+                sys.stderr.write('Stage %s failed: %s\n' % (name, err))
+                items = []
+                with self.lock:
+                    stats['errors'] += 1
+            with self.lock:
+                stats['items'] += 1
+                stats['busy'] += time.time() - start
+            for item in items:
+                self.queues[i + 1].put(item)
+        with self.lock:
+            stats['finished'] += 1
+            last = stats['finished'] == self.stages[i][2]
+        if last:
+            downstream = (self.stages[i + 1][2] if i + 1 < len(self.stages)
+                          else 1)
+            for _ in range(downstream):
+                self.queues[i + 1].put(self.DONE)
+
+    def report(self):
+        """Write throughput and queue depth of every stage to stderr."""
+        elapsed = max(time.time() - self.start, 0.001)
+        for i, stats in enumerate(self.stats):
+            workers = self.stages[i][2]
+            sys.stderr.write(
+                '%-10s %6d items %8.1f/s  %3.0f%% busy  queue %d (max %d)'
+                '  errors %d\n'
+                % (stats['name'], stats['items'], stats['items'] / elapsed,
+                   100 * stats['busy'] / (elapsed * workers),
+                   self.queues[i].qsize(), stats['max_depth'],
+                   stats['errors']))
+
+
+class PhaseTimer(object):
+    """
+    Wall and CPU time spent in named phases of a run.
+
+    Phases are timed per thread and summed, so phases running concurrently
+    can add up to more than the run took. Time in a nested phase is only
+    counted for the innermost phase. A disabled timer records nothing.
+    """
+
+    def __init__(self, enabled=True):
+        """Start with no recorded time."""
+        self.enabled = enabled
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as phase name."""
+        stack = self.local.__dict__.setdefault('stack', [])
+        if not self.enabled or (stack and stack[-1] == name):
+            yield
+            return
+        now = (time.time(), thread_cpu_time())
+        if stack:
+            self.add(stack[-1], now, 0)
+        stack.append(name)
+        self.local.start = now
+        try:
+            yield
+        finally:
+            now = (time.time(), thread_cpu_time())
+            self.add(stack.pop(), now, 1)
+            self.local.start = now
+
+    def add(self, name, now, calls):
+        """Charge the time since the thread's last mark to phase name."""
+        start = self.local.start
+        with self.lock:
+            totals = self.totals.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += calls
+            totals[1] += now[0] - start[0]
+            totals[2] += now[1] - start[1]
+
+    def wrap(self, name, func):
+        """Return func timed as phase name."""
+        def timed(*args, **kwargs):
+            """Call func within the phase."""
+            with self.phase(name):
+                return func(*args, **kwargs)
+        return timed
+
+
+class TraceRecorder(object):
+    """
+    Spans of a run in Chrome trace event format.
+
+    Each span is a complete event on the thread which ran it, so the file
+    written by save() shows concurrency, serialization points and tail
+    latency in chrome://tracing or Perfetto. A disabled recorder records
+    nothing.
+    """
+
+    def __init__(self, enabled=True):
+        """Start an empty trace."""
+        self.enabled = enabled
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def span(self, name, category):
+        """Record the body of a with statement, yielding the span args."""
+        args = {}
+        if not self.enabled:
+            yield args
+            return
+        start = time.time()
+        try:
+            yield args
+        except Exception as err:
+            args['error'] = '%s' % err
+            raise
+        finally:
+            end = time.time()
+            thread = threading.current_thread()
+            with self.lock:
+                tid = self.threads.setdefault(
+                    thread.ident, (len(self.threads) + 1, thread.name))[0]
+                self.events.append({
+                    "name": name, "cat": category, "ph": "X", "pid": 1,
+                    "tid": tid, "ts": int((start - self.start) * 1000000),
+                    "dur": int((end - start) * 1000000), "args": args
+                })
+
+    def save(self, path):
+        """Write the recorded spans as a Chrome trace event JSON file."""
+        events = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid,
+                   "args": {"name": name}}
+                  for tid, name in self.threads.values()]
+        with open(path, 'w') as outfile:
+            json.dump({"traceEvents": events + self.events,
+                       "displayTimeUnit": "ms"}, outfile)
+
+
+class CachingRestClient(object):
+    """
+    Read-through cache in front of a RestClient.
+
+    GET responses are kept for the rest of the run keyed by path and
+    params, unless requested with store=False. POST, PUT and DELETE
+    invalidate only what they can change: the collection listing and the
+    mutated item, or the whole collection when the mutation creates an
+    item or affects every item. Requests which reach restclient are timed
+    as the fetch and mutate phases of phases and recorded as spans by
+    tracer.
+    """
+
+    def __init__(self, restclient, phases=None, tracer=None):
+        """Wrap restclient."""
+        self.restclient = restclient
+        self.phases = phases or PhaseTimer(enabled=False)
+        self.tracer = tracer or TraceRecorder(enabled=False)
+        self.responses = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidation_callbacks = []
+        self.lock = threading.Lock()
+
+    def get(self, uri_path='', store=True, **kwargs):
+        """
+        GET uri_path, answering from the cache when possible.
+
+        With store=False the response is not kept, for pages which are
+        only read once.
+        """
+        key = (uri_path, json.dumps(kwargs.get('params'), sort_keys=True))
+        with self.lock:
+            resp = self.responses.get(key)
+            if resp is not None:
+                self.hits += 1
+                return resp
+            self.misses += 1
+        resp = self.send('get', uri_path, **kwargs)
+        if store and resp.status_code == 200:
+            with self.lock:
+                self.responses[key] = resp
+        return resp
+
+    def post(self, uri_path='', **kwargs):
+        """POST uri_path and invalidate what it changes."""
+        return self.mutate('post', uri_path, **kwargs)
+
+    def put(self, uri_path='', **kwargs):
+        """PUT uri_path and invalidate what it changes."""
+        return self.mutate('put', uri_path, **kwargs)
+
+    def delete(self, uri_path='', **kwargs):
+        """DELETE uri_path and invalidate what it changes."""
+        return self.mutate('delete', uri_path, **kwargs)
+
+    def mutate(self, method, uri_path, **kwargs):
+        """Send a mutating request and invalidate what it changes."""
+        resp = None
+        try:
+            resp = self.send(method, uri_path, **kwargs)
+            return resp
+        finally:
+            self.invalidate(uri_path, method, resp)
+
+    def send(self, method, uri_path, **kwargs):
+        """Send a request to restclient, timing and tracing it."""
+        with self.phases.phase('fetch' if method == 'get' else 'mutate'):
+            with self.tracer.span('%s %s' % (method.upper(),
+                                             endpoint_template(uri_path)),
+                                  'api') as args:
+                args.update({'method': method.upper(), 'path': uri_path})
+                resp = getattr(self.restclient, method)(uri_path, **kwargs)
+                args.update({
+                    'status': resp.status_code,
+                    'bytes': len(getattr(resp, 'content', None) or
+                                 resp.text or '')
+                })
+        return resp
+
+    def invalidate(self, uri_path, method=None, resp=None):
+        """
+        Drop cached responses which uri_path can change.
+
+        The invalidation callbacks are passed uri_path and the method and
+        response of the mutation, or None when they are not known.
+        """
+        collection = collection_path(uri_path)
+        item_path = uri_path[:len(collection)] + '/'.join(
+            uri_path[len(collection):].split('/')[:2])
+        whole_collection = (item_path == collection or
+                            item_path in COLLECTION_WIDE_MUTATIONS)
+        with self.lock:
+            for key in self.responses.keys():
+                path = key[0]
+                if (path == collection or
+                        (whole_collection and
+                         path.startswith(collection + '/')) or
+                        path == item_path or
+                        path.startswith(item_path + '/')):
+                    del self.responses[key]
+        for callback in self.invalidation_callbacks:
+            callback(uri_path, method, resp)
+
+
+class ResilientRestClient(object):
+    """
+    Timeouts, retries and circuit breaking in front of a RestClient.
+
+    Every request gets a (connect, read) timeout, extending the read
+    timeout to that of ENDPOINT_READ_TIMEOUTS for slow collections. GET,
+    PUT and DELETE are retried on errors and RETRY_STATUS_CODES, POST only
+    when it cannot have been processed, after exponential backoff with
+    full jitter. After
+    CIRCUIT_FAILURE_THRESHOLD consecutive failures of a collection its
+    circuit opens and requests to it raise CircuitOpenError for
+    CIRCUIT_COOLDOWN seconds, after which one trial request decides whether
+    it closes again. Requests, retries, timeouts and failures are counted
+    per collection in stats.
+    """
+
+    def __init__(self, restclient, connect_timeout, read_timeout, retries):
+        """Wrap restclient."""
+        self.restclient = restclient
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.circuits = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def get(self, uri_path='', **kwargs):
+        """GET uri_path."""
+        return self.send('get', uri_path, **kwargs)
+
+    def post(self, uri_path='', **kwargs):
+        """POST uri_path."""
+        return self.send('post', uri_path, **kwargs)
+
+    def put(self, uri_path='', **kwargs):
+        """PUT uri_path."""
+        return self.send('put', uri_path, **kwargs)
+
+    def delete(self, uri_path='', **kwargs):
+        """DELETE uri_path."""
+        return self.send('delete', uri_path, **kwargs)
+
+    def send(self, method, uri_path, **kwargs):
+        """
+        Send a request to restclient, retrying it while that is safe.
+
+        Raises the last error, or returns the last response, once the
+        retries are used up.
+        """
+        collection = collection_path(uri_path)
+        read_timeout = max(self.read_timeout,
+                           ENDPOINT_READ_TIMEOUTS.get(collection, 0))
+        kwargs.setdefault('timeout', (self.connect_timeout, read_timeout))
+        self.count(collection, 'requests')
+        attempt = 0
+        while True:
+            trial = self.admit(collection)
+            try:
+                resp = getattr(self.restclient, method)(uri_path, **kwargs)
+            except requests.exceptions.RequestException as err:
+                if isinstance(err, requests.exceptions.Timeout):
+                    self.count(collection, 'timeouts')
+                self.record(collection, True, trial)
+                if (attempt >= self.retries or
+                        (method == 'post' and not request_not_sent(err))):
+                    self.count(collection, 'failed')
+                    raise
+                delay = backoff_delay(attempt)
+            else:
+                transient = resp.status_code in RETRY_STATUS_CODES
+                self.record(collection, transient, trial)
+                if (not transient or attempt >= self.retries or
+                        (method == 'post' and resp.status_code != 429)):
+                    if resp.status_code >= 400:
+                        self.count(collection, 'failed')
+                    return resp
+                delay = backoff_delay(attempt,
+                                      resp.headers.get('Retry-After'))
+            self.count(collection, 'retries')
+            time.sleep(delay)
+            attempt += 1
+
+    def admit(self, collection):
+        """
+        Raise CircuitOpenError unless a request to collection may be sent.
+
+        Returns whether the request is the trial request of an open circuit.
+        """
+        with self.lock:
+            circuit = self.circuits.setdefault(
+                collection, {"failures": 0, "opened_at": None, "trial": False})
+            if circuit['opened_at'] is None:
+                return False
+            remaining = circuit['opened_at'] + CIRCUIT_COOLDOWN - time.time()
+            if remaining <= 0 and not circuit['trial']:
+                circuit['trial'] = True
+                return True
+            failures = circuit['failures']
+        self.count(collection, 'rejected')
+        raise CircuitOpenError(
+            'Circuit open for %s after %d consecutive failures, failing fast '
+            'for another %ds' % (collection, failures, max(remaining, 0)))
+
+    def record(self, collection, failed, trial):
+        """Record the outcome of a request in the circuit of collection."""
+        with self.lock:
+            circuit = self.circuits[collection]
+            if trial:
+                circuit['trial'] = False
+            if not failed:
+                circuit['failures'] = 0
+                circuit['opened_at'] = None
+                return
+            circuit['failures'] += 1
+            opened = trial or (circuit['opened_at'] is None and
+                               circuit['failures'] >=
+                               CIRCUIT_FAILURE_THRESHOLD)
+            if opened:
+                circuit['opened_at'] = time.time()
+        if opened:
+            self.count(collection, 'opened')
+
+    def count(self, collection, name):
+        """Add one to counter name of collection."""
+        with self.lock:
+            stats = self.stats.setdefault(collection, dict.fromkeys(
+                ['requests', 'retries', 'timeouts', 'failed', 'opened',
+                 'rejected'], 0))
+            stats[name] += 1
+
+
+class CachedResponse(object):
+    """Response answered from the on-disk cache."""
+
+    def __init__(self, entry):
+        """Setup from a cache entry."""
+        self.status_code = entry['status_code']
+        self.text = entry['text']
+        self.headers = {}
+
+
+class DiskCachingRestClient(object):
+    """
+    Persistent on-disk cache in front of a RestClient.
+
+    Only GETs of the endpoints in DISK_CACHE_TTLS are cached. An entry is
+    answered from disk until its TTL expires, then revalidated with
+    If-None-Match/If-Modified-Since when the server sent an ETag or
+    Last-Modified. Entries are keyed by the API endpoint and key, so
+    tenants sharing a cluster never see each other's entries. The cache
+    directory is kept below max_bytes by evicting the least recently used
+    entries.
+    """
+
+    def __init__(self, restclient, apiendpoint, cache_dir, max_bytes,
+                 refresh=False):
+        """Wrap restclient."""
+        self.restclient = restclient
+        self.apiendpoint = apiendpoint
+        self.api_key_hash = hashlib.sha1(
+            getattr(restclient, 'api_key', None) or '').hexdigest()
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, uri_path='', **kwargs):
+        """GET uri_path, answering from disk when possible."""
+        ttl = DISK_CACHE_TTLS.get(uri_path)
+        if ttl is None:
+            return self.restclient.get(uri_path, **kwargs)
+        path = self.entry_path(uri_path, kwargs.get('params'))
+        entry = None if self.refresh else self.read_entry(path)
+        if entry is not None and time.time() - entry['stored_at'] < ttl:
+            os.utime(path, None)
+            self.hits += 1
+            return CachedResponse(entry)
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        resp = self.conditional_get(uri_path, headers, **kwargs)
+        if resp.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            entry['stored_at'] = time.time()
+            self.write_entry(path, entry)
+            return CachedResponse(entry)
+        self.misses += 1
+        if resp.status_code == 200:
+            self.write_entry(path, {
+                "path": uri_path,
+                "stored_at": time.time(),
+                "etag": resp.headers.get('ETag'),
+                "last_modified": resp.headers.get('Last-Modified'),
+                "status_code": resp.status_code,
+                "text": resp.text
+            })
+            self.evict()
+        return resp
+
+    def post(self, uri_path='', **kwargs):
+        """POST uri_path and drop cached entries for its collection."""
+        return self.mutate('post', uri_path, **kwargs)
+
+    def put(self, uri_path='', **kwargs):
+        """PUT uri_path and drop cached entries for its collection."""
+        return self.mutate('put', uri_path, **kwargs)
+
+    def delete(self, uri_path='', **kwargs):
+        """DELETE uri_path and drop cached entries for its collection."""
+        return self.mutate('delete', uri_path, **kwargs)
+
+    def mutate(self, method, uri_path, **kwargs):
+        """Send a mutating request and drop cached entries it changes."""
+        try:
+            return getattr(self.restclient, method)(uri_path, **kwargs)
+        finally:
+            collection = collection_path(uri_path)
+            for cached_path in DISK_CACHE_TTLS:
+                if collection_path(cached_path) == collection:
+                    for path in glob.glob(os.path.join(
+                            self.cache_dir,
+                            self.entry_prefix(cached_path) + '-*.json')):
+                        os.remove(path)
+
+    def conditional_get(self, uri_path, headers, **kwargs):
+        """
+        GET uri_path with conditional request headers.
+
+        A copy of the client with its own session is used so the headers
+        never leak into concurrent requests on the shared session.
+        """
+        if not headers or not hasattr(self.restclient, 'session'):
+            return self.restclient.get(uri_path, **kwargs)
+        restclient = copy.copy(self.restclient)
+        restclient.session = requests.Session()
+        restclient.session.headers.update(headers)
+        return restclient.get(uri_path, **kwargs)
+
+    def entry_prefix(self, uri_path):
+        """Return the file name prefix of entries for uri_path."""
+        return hashlib.sha1('\0'.join(
+            [self.apiendpoint, self.api_key_hash, uri_path])).hexdigest()
+
+    def entry_path(self, uri_path, params):
+        """Return the file holding the entry for uri_path and params."""
+        params_hash = hashlib.sha1(
+            json.dumps(params, sort_keys=True)).hexdigest()[:12]
+        return os.path.join(self.cache_dir, '%s-%s.json'
+                            % (self.entry_prefix(uri_path), params_hash))
+
+    def read_entry(self, path):
+        """Read a cache entry, or None when missing or unreadable."""
+        try:
+            with open(path) as infile:
+                return json.load(infile)
+        except (IOError, ValueError):
+            return None
+
+    def write_entry(self, path, entry):
+        """Write a cache entry, replacing any previous one."""
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as outfile:
+            json.dump(entry, outfile)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    def evict(self):
+        """Evict least recently used entries until under max_bytes."""
+        entries = []
+        total = 0
+        for path in glob.glob(os.path.join(self.cache_dir, '*.json')):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        while total > self.max_bytes and entries:
+            _mtime, size, path = entries.pop(0)
+            os.remove(path)
+            total -= size
+
+
+class RateLimiter(object):
+    """Spaces calls to wait() at no more than rate per second."""
+
+    def __init__(self, rate):
+        """Allow rate calls per second, or any number when rate is 0."""
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next call is allowed, across all threads."""
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Sensor(object):
+    """
+    Compact sensor record.
+
+    Keeps only the fields the sensor actions use. Interface IPv4 addresses
+    are packed as integers into an array alongside the VRF id of each
+    interface, and repeated strings such as platform and version are
+    shared between records.
+    """
+
+    __slots__ = ('uuid', 'host_name', 'platform', 'agent_type',
+                 'current_sw_version', 'created_at', 'last_config_fetch_at',
+                 'deleted_at', 'ipv4', 'ipv4_vrf_ids', 'ipv6')
+
+    def __init__(self, key):
+        """Setup from a /sensors API record."""
+        self.uuid = key['uuid']
+        self.host_name = key.get('host_name')
+        self.platform = shared_string(key.get('platform'))
+        self.agent_type = shared_string(key.get('agent_type'))
+        self.current_sw_version = shared_string(key.get('current_sw_version'))
+        self.created_at = key.get('created_at')
+        self.last_config_fetch_at = key.get('last_config_fetch_at')
+        self.deleted_at = key.get('deleted_at')
+        self.ipv4 = array.array('I')
+        self.ipv4_vrf_ids = array.array('i')
+        ipv6 = []
+        for _int in key.get('interfaces', []):
+            if _int.get('family_type') == "IPV4":
+                if not _int['ip'].startswith('127.'):
+                    self.ipv4.append(ip_to_int(_int['ip']))
+                    self.ipv4_vrf_ids.append(_int.get('vrf_id') or 0)
+            elif _int.get('ip'):
+                ipv6.append(_int['ip'])
+        self.ipv6 = tuple(ipv6)
+
+    def ips(self):
+        """Return the interface IPv4 addresses in dotted form."""
+        return [int_to_ip(ip) for ip in self.ipv4]
+
+
+class InventorySnapshot(object):
+    """
+    Columnar inventory snapshot for local scope query evaluation.
+
+    IPv4 addresses are held as a numpy uint32 array and every other field
+    as categorical codes, so a scope query compiles to a handful of
+    vectorized comparisons over the whole inventory.
+    """
+
+    def __init__(self, ips, columns):
+        """Setup from IPv4 integers and a dict of field to value lists."""
+        self.ips = numpy.array(ips, dtype=numpy.uint32)
+        self.raw_columns = columns
+        self.columns = {}
+
+    @classmethod
+    def from_items(cls, items):
+        """Build a snapshot from inventory search results."""
+        ips = []
+        columns = {}
+        for item in items:
+            if ':' in item.get('ip', ':'):
+                continue
+            for field in columns:
+                columns[field].append(item.get(field))
+            for field in item:
+                if field != 'ip' and field not in columns:
+                    columns[field] = [None] * len(ips) + [item[field]]
+            ips.append(ip_to_int(item['ip']))
+        return cls(ips, columns)
+
+    @classmethod
+    def from_sensors(cls, sensors):
+        """Build a snapshot from the IPv4 interfaces of Sensor records."""
+        ips = []
+        columns = {'host_name': [], 'os': [], 'vrf_id': []}
+        for sensor in sensors:
+            for ip, vrf_id in zip(sensor.ipv4, sensor.ipv4_vrf_ids):
+                ips.append(ip)
+                columns['host_name'].append(sensor.host_name)
+                columns['os'].append(sensor.platform)
+                columns['vrf_id'].append(vrf_id)
+        return cls(ips, columns)
+
+    def __len__(self):
+        """Return the number of inventory items."""
+        return len(self.ips)
+
+    def column(self, field):
+        """Return the (categories, codes) of a field, built on first use."""
+        if field not in self.columns:
+            if field not in self.raw_columns:
+                raise ValueError('Unknown field: %s' % field)
+            values = [u'' if value is None else unicode(value)
+                      for value in self.raw_columns[field]]
+            categories, codes = numpy.unique(values, return_inverse=True)
+            self.columns[field] = (categories, codes)
+        return self.columns[field]
+
+    def evaluate(self, query):
+        """Return a boolean mask of the items matching a scope query."""
+        query_type = query.get('type')
+        if query_type in ('and', 'or'):
+            masks = [self.evaluate(sub_query)
+                     for sub_query in query.get('filters', [])]
+            if not masks:
+                return numpy.ones(len(self), dtype=bool)
+            if query_type == 'and':
+                return numpy.logical_and.reduce(masks)
+            return numpy.logical_or.reduce(masks)
+        if query_type == 'not':
+            return ~self.evaluate(query['filter'])
+        field = query.get('field')
+        value = query.get('value')
+        if field == 'ip':
+            if query_type == 'subnet' or (query_type in ('eq', 'ne') and
+                                          '/' in value):
+                start, end = cidr_range(value)
+                mask = ((self.ips >= numpy.uint32(start)) &
+                        (self.ips <= numpy.uint32(end)))
+            elif query_type in ('eq', 'ne'):
+                mask = self.ips == numpy.uint32(ip_to_int(value))
+            else:
+                raise ValueError('Unsupported ip query type: %s' % query_type)
+        else:
+            categories, codes = self.column(field)
+            value = unicode(value)
+            if query_type in ('eq', 'ne'):
+                matches = numpy.flatnonzero(categories == value)
+            elif query_type == 'contains':
+                matches = [i for i, category in enumerate(categories)
+                           if value in category]
+            else:
+                raise ValueError('Unsupported query type: %s' % query_type)
+            mask = numpy.in1d(codes, matches)
+        if query_type == 'ne':
+            return ~mask
+        return mask
+
+
+class SensorIpIndex(object):
+    """
+    Sorted index of every sensor interface IPv4 address.
+
+    Addresses are flattened into one sorted numpy uint32 array with a
+    parallel array of owning sensor positions, so any number of CIDRs are
+    matched with two vectorized binary searches.
+    """
+
+    def __init__(self, sensors):
+        """Setup from a list of Sensor records."""
+        self.sensors = sensors
+        counts = numpy.array([len(sensor.ipv4) for sensor in sensors],
+                             dtype=numpy.int64)
+        ips = numpy.fromiter(
+            itertools.chain.from_iterable(sensor.ipv4 for sensor in sensors),
+            dtype=numpy.uint32, count=int(counts.sum()))
+        owners = numpy.repeat(numpy.arange(len(sensors)), counts)
+        order = numpy.argsort(ips, kind='mergesort')
+        self.ips = ips[order]
+        self.owners = owners[order]
+
+    def match(self, cidrs):
+        """Return the list of matching Sensor records for each CIDR."""
+        ranges = numpy.array([cidr_range(cidr) for cidr in cidrs],
+                             dtype=numpy.uint32).reshape(-1, 2)
+        lows = numpy.searchsorted(self.ips, ranges[:, 0], side='left')
+        highs = numpy.searchsorted(self.ips, ranges[:, 1], side='right')
+        return [[self.sensors[i] for i in
+                 numpy.unique(self.owners[low:high])]
+                for low, high in zip(lows, highs)]
+
+
+_SHARED_STRINGS = {}
+
+
+def shared_string(value):
+    """Return a shared copy of a frequently repeated string."""
+    return _SHARED_STRINGS.setdefault(value, value)
+
+
+def ip_to_int(ip):
+    """Return an IPv4 address as an integer."""
+    try:
+        return struct.unpack('!L', socket.inet_aton(ip))[0]
+    except socket.error:
+        raise ValueError('Invalid IPv4 address: %s' % ip)
+
+
+def cidr_range(cidr):
+    """Return the first and last IPv4 address of a CIDR as integers."""
+    network, _sep, prefix = cidr.strip().partition('/')
+    netmask = (0xffffffff << (32 - int(prefix or 32))) & 0xffffffff
+    start = ip_to_int(network) & netmask
+    return start, start | (~netmask & 0xffffffff)
+
+
+def int_to_ip(value):
+    """Return an integer as a dotted IPv4 address."""
+    return socket.inet_ntoa(struct.pack('!L', value))
+
+
+def age_stats(ages):
+    """
+    Return percentiles in days and a histogram of ages in seconds.
+
+    ages is a numpy array where unknown ages are NaN.
+    """
+    known = ages[~numpy.isnan(ages)]
+    python_data = {"unknown": int(len(ages) - len(known))}
+    if not len(known):
+        return python_data
+    percentiles = numpy.percentile(known, SENSOR_STATS_PERCENTILES)
+    python_data['percentiles_days'] = dict(
+        ('p%d' % percentile, round(float(value) / 86400, 2))
+        for percentile, value in zip(SENSOR_STATS_PERCENTILES, percentiles))
+    bounds = numpy.array([bound for _label, bound in SENSOR_AGE_BUCKETS[:-1]],
+                         dtype=numpy.float64)
+    counts = numpy.bincount(numpy.searchsorted(bounds, known, side='right'),
+                            minlength=len(SENSOR_AGE_BUCKETS))
+    python_data['histogram'] = [
+        {"bucket": label, "count": int(count)}
+        for (label, _bound), count in zip(SENSOR_AGE_BUCKETS, counts)]
+    return python_data
+
+
+def deep_getsizeof(obj, seen=None):
+    """Return the size in bytes of obj and everything it references."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_getsizeof(key, seen) + deep_getsizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for value in obj:
+            size += deep_getsizeof(value, seen)
+    elif hasattr(obj, '__slots__'):
+        for name in obj.__slots__:
+            size += deep_getsizeof(getattr(obj, name, None), seen)
+    return size
+
+
+def mock_sensors(count):
+    """Return count /sensors API records of mock data."""
+    rand = random.Random(0)
+    platforms = ['CentOS-7.4', 'MSWindows2012R2', 'MSWindows2016',
+                 'RedHatEnterpriseServer-7.4', 'Ubuntu-16.04']
+    versions = ['2.2.1.31.devel', '2.3.1.41', '2.3.1.45']
+    sensors = []
+    for i in range(count):
+        interfaces = [{
+            "family_type": "IPV4", "ip": "127.0.0.1", "mac": "",
+            "name": "lo", "netmask": "255.0.0.0", "vrf": "Default",
+            "vrf_id": 1
+        }]
+        for j in range(rand.randint(1, 3)):
+            interfaces.append({
+                "family_type": "IPV4",
+                "ip": "10.%d.%d.%d" % (j, i // 250 % 250, i % 250),
+                "mac": "00:50:56:%02x:%02x:%02x" % (j, i // 256 % 256,
+                                                    i % 256),
+                "name": "eth%d" % j, "netmask": "255.255.0.0",
+                "vrf": "Default", "vrf_id": 1
+            })
+            interfaces.append({
+                "family_type": "IPV6",
+                "ip": "fe80::250:56ff:fe%02x:%04x" % (j, i % 65536),
+                "mac": "00:50:56:%02x:%02x:%02x" % (j, i // 256 % 256,
+                                                    i % 256),
+                "name": "eth%d" % j, "netmask": "ffff:ffff:ffff:ffff::",
+                "vrf": "Default", "vrf_id": 1
+            })
+        sensors.append({
+            "agent_type": "ENFORCER",
+            "auto_upgrade_opt_out": False,
+            "created_at": 1500000000 + i,
+            "current_sw_version": rand.choice(versions),
+            "data_plane_disabled": False,
+            "desired_sw_version": versions[-1],
+            "enable_conversation_mode": False,
+            "enable_pid_lookup": True,
+            "host_name": "host%06d" % i,
+            "interfaces": interfaces,
+            "last_config_fetch_at": 1508000000 + rand.randint(0, 86400 * 30),
+            "last_software_update_at": 1505000000,
+            "platform": rand.choice(platforms),
+            "uuid": hashlib.sha1(str(i)).hexdigest()
+        })
+    return sensors
+
+
+def thread_cpu_time():
+    """
+    Return CPU seconds used by the calling thread.
+
+    Falls back to the CPU time of the whole process where per-thread usage
+    is not available.
+    """
+    if resource is not None and sys.platform.startswith('linux'):
+        usage = resource.getrusage(RUSAGE_THREAD)
+    else:
+        return sum(os.times()[:2])
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_memory():
+    """Return the peak resident memory of the process in bytes, or None."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def endpoint_template(uri_path):
+    """Return uri_path with its object id segments replaced by {id}."""
+    return '/'.join('{id}' if TRACE_ID_SEGMENT.match(segment) else segment
+                    for segment in uri_path.split('?')[0].split('/'))
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Return the seconds to wait before retrying after attempt.
+
+    A numeric Retry-After is honoured, otherwise the delay is drawn
+    uniformly up to the exponential backoff (full jitter). Both are capped
+    at RETRY_MAX_DELAY.
+    """
+    try:
+        return min(max(float(retry_after), 0), RETRY_MAX_DELAY)
+    except (TypeError, ValueError):
+        return random.uniform(0, min(RETRY_MAX_DELAY,
+                                     RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def request_not_sent(err):
+    """Return whether a request failed before it reached the server."""
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(err.args[0] if err.args else None, 'reason', None)
+    return isinstance(reason,
+                      requests.packages.urllib3.exceptions.NewConnectionError)
+
+
+def iter_records(restclient, uri_path, **kwargs):
+    """
+    Iterate the records of uri_path fetched with restclient.
+
+    Paged collections such as /sensors are requested one page at a time
+    following the offset returned by the API. Raises TetrationError when a
+    page cannot be fetched.
+    """
+    params = None
+    while True:
+        if params is None:
+            resp = restclient.get(uri_path, **kwargs)
+        else:
+            resp = restclient.get(uri_path, params=params, **kwargs)
+        if resp.status_code != 200:
+            raise TetrationError('GET %s returned status %s'
+                                 % (uri_path, resp.status_code))
+        python_data = json.loads(resp.text)
+        if not isinstance(python_data, dict):
+            for key in python_data:
+                yield key
+            return
+        for key in python_data.get('results', []):
+            yield key
+        if not python_data.get('offset'):
+            return
+        params = {'offset': python_data['offset']}
+
+
+def collection_path(uri_path):
+    """Return the API collection uri_path belongs to."""
+    for collection in COLLECTIONS:
+        if uri_path == collection or uri_path.startswith(collection + '/'):
+            return collection
+    return '/' + uri_path.strip('/').split('/')[0]
+
+
+def sensor_fingerprint(key):
+    """Return a fingerprint of a /sensors record ignoring volatile fields."""
+    key = dict((field, value) for field, value in key.iteritems()
+               if field not in WATCH_VOLATILE_FIELDS)
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).digest()
+
+
+def cluster_members(cluster):
+    """Return the set of member addresses of an ADM cluster."""
+    return set(node.get('ip') or node.get('name')
+               for node in cluster.get('nodes', []))
+
+
+def unindex(index, record):
+    """Remove record from every list and map of an in-memory index."""
+    for value in index.itervalues():
+        if isinstance(value, list):
+            value[:] = [key for key in value if key is not record]
+        elif isinstance(value, dict):
+            for name, entry in value.items():
+                if entry is record:
+                    del value[name]
+                elif isinstance(entry, list):
+                    entry[:] = [key for key in entry if key is not record]
+
+
+def cluster_fingerprint(members):
+    """Return a fingerprint of a cluster member set."""
+    return hashlib.sha1('\n'.join(sorted(members))).hexdigest()
+
+
+def colored(text, *args, **kwargs):
+    """Colour text with termcolor only when stdout is a terminal."""
+    if not sys.stdout.isatty():
+        return text
+    return termcolor_colored(text, *args, **kwargs)
+
+
+def result_records(python_data):
+    """Return results as records, turning a dict into key/value records."""
+    if isinstance(python_data, dict):
+        return [{'key': key, 'value': value} for key, value
+                in sorted(python_data.iteritems())]
+    return python_data
+
+
+def positions_bitmap(positions, size):
+    """Return an int bitmap of size bits with the given bit positions set."""
+    if not size:
+        return 0
+    bits = bytearray('0' * size)
+    for position in positions:
+        bits[size - 1 - position] = '1'
+    return int(str(bits), 2)
+
+
+def bitmap_positions(bitmap):
+    """Return the positions of the bits set in an int bitmap."""
+    return [position for position, bit in enumerate(bin(bitmap)[:1:-1])
+            if bit == '1']
+
+
+def table_cell(value):
+    """Return a record value as a single line table cell."""
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, separators=(',', ':'))
+    elif not isinstance(value, basestring):
+        value = str(value)
+    return value.replace('\n', ' ')
+
 
 class Tetration(object):
     """Main execution."""
 
     def __init__(self):
         """Setup initial call."""
+        self.cache = {}
+        self.index_lock = threading.Lock()
         self.read_cli_args()
-        self.auth()
-        self.decide_action()
+        self.phases = PhaseTimer(enabled=self.args.profile is not None)
+        self.tracer = TraceRecorder(enabled=self.args.trace is not None)
+        try:
+            if self.args.profile is not None:
+                self.run_profiled()
+            else:
+                self.run()
+        finally:
+            if self.args.trace is not None:
+                self.tracer.save(self.args.trace)
+                sys.stderr.write('Trace of %d spans written to %s\n'
+                                 % (len(self.tracer.events), self.args.trace))
+
+    def run(self):
+        """Authenticate and run the action."""
+        with self.phases.phase('auth'):
+            self.auth()
+        try:
+            self.decide_action()
+        except (TetrationError, requests.exceptions.RequestException) as err:
+            sys.stderr.write('%s\n' % err)
+            sys.exit(1)
+        finally:
+            self.report_cache_stats()
+            self.report_failures()
+
+    def run_profiled(self):
+        """
+        Run The Action Under cProfile.
+
+        Writes pstats for the main thread to --profile and reports wall and
+        CPU time per phase and peak memory on stderr. JSON decoding and CSV
+        reading are timed as the parse phase.
+        """
+        json.load = self.phases.wrap('parse', json.load)
+        json.loads = self.phases.wrap('parse', json.loads)
+        profiler = cProfile.Profile()
+        start = (time.time(), sum(os.times()[:2]))
+        try:
+            profiler.runcall(self.run)
+        finally:
+            elapsed = (time.time() - start[0],
+                       sum(os.times()[:2]) - start[1])
+            profiler.dump_stats(self.args.profile)
+            self.report_phases(elapsed)
 
     def auth(self):
         """Setup Auth."""
+        if (self.args.action in OFFLINE_ACTIONS or
+                self.args.clustersfile is not None):
+            return
         if self.args.credsfile is not None:
-            self.restclient = (RestClient(self.args.apiendpoint,
-                                          credentials_file=self.args.credsfile,
-                                          verify=False))
+            restclient = RestClient(self.args.apiendpoint,
+                                    credentials_file=self.args.credsfile,
+                                    verify=False, max_retries=0)
+            if not self.args.no_cache:
+                restclient = DiskCachingRestClient(
+                    restclient, self.args.apiendpoint,
+                    os.path.expanduser(self.args.cachedir),
+                    self.args.cachesize * 1024 * 1024,
+                    refresh=self.args.refresh)
+            restclient = ResilientRestClient(
+                restclient, self.args.connecttimeout, self.args.readtimeout,
+                self.args.retries)
+            self.restclient = CachingRestClient(restclient, self.phases,
+                                                self.tracer)
+            self.restclient.invalidation_callbacks.append(
+                self.invalidate_indexes)
 
     def decide_action(self):
         """
@@ -123,22 +1651,38 @@ class Tetration(object):
 
         Based on action passed determine which action to take.
         """
+        if self.args.clustersfile is not None:
+            self.fanout()
+            return
+        self.invalid_rows = set()
+        if (self.args.readcsv is not None and
+                self.args.action in PREFLIGHT_ACTIONS):
+            if not self.preflight():
+                return
         if self.args.action == "add_user_roles":
             self.add_user_roles()
         if self.args.action == "add_user_to_role":
             self.add_user_to_role()
         if self.args.action == "add_users":
             self.add_users()
+        if self.args.action == "bench_sensor_memory":
+            self.bench_sensor_memory()
+        if self.args.action == "cleanup_sensors":
+            self.cleanup_sensors()
         if self.args.action == "create_app":
             self.create_app()
         if self.args.action == "create_app_scope":
             self.create_app_scope()
+        if self.args.action == "create_inventory_filters":
+            self.create_inventory_filters()
         if self.args.action == "delete_app":
             self.delete_app()
         if self.args.action == "delete_sensor":
             self.delete_sensor()
         if self.args.action == "delete_users":
             self.delete_users()
+        if self.args.action == "diff_app_clusters":
+            self.diff_app_clusters()
         if self.args.action == "get_app":
             self.get_app()
         if self.args.action == "get_app_clusters":
@@ -147,6 +1691,8 @@ class Tetration(object):
             self.get_apps()
         if self.args.action == "get_app_scope":
             self.get_app_scope()
+        if self.args.action == "get_app_scope_tree":
+            self.get_app_scope_tree()
         if self.args.action == "get_app_scopes":
             self.get_app_scopes()
         if self.args.action == "get_flow_dimensions":
@@ -155,8 +1701,12 @@ class Tetration(object):
             self.get_flow_metrics()
         if self.args.action == "get_inventory_dimensions":
             self.get_inventory_dimensions()
+        if self.args.action == "get_inventory_filter":
+            self.get_inventory_filter()
         if self.args.action == "get_inventory_filters":
             self.get_inventory_filters()
+        if self.args.action == "get_role_members":
+            self.get_role_members()
         if self.args.action == "get_sensor":
             self.get_sensor()
         if self.args.action == "get_sensors":
@@ -169,78 +1719,32 @@ class Tetration(object):
             self.get_user_roles()
         if self.args.action == "get_users":
             self.get_users()
+        if self.args.action == "get_vrf_inventory":
+            self.get_vrf_inventory()
         if self.args.action == "get_vrfs":
             self.get_vrfs()
+        if self.args.action == "match_sensor_subnets":
+            self.match_sensor_subnets()
+        if self.args.action == "preview_app_scopes":
+            self.preview_app_scopes()
+        if self.args.action == "query":
+            self.query()
         if self.args.action == "remove_user_from_role":
             self.remove_user_from_role()
+        if self.args.action == "sensor_stats":
+            self.sensor_stats()
+        if self.args.action == "sync":
+            self.sync()
+        if self.args.action == "update_user_roles":
+            self.update_user_roles()
+        if self.args.action == "watch":
+            self.watch()
 
     def add_user_roles(self):
         """Add roles."""
         self.get_user_roles()
         if self.args.readcsv is not None:
-            try:
-                f = open(self.args.readcsv)
-                csv_f = csv.reader(f)
-                next(csv_f, None)  # skip headers
-                for row in csv_f:
-                    self.args.userrole = row[0]
-                    self.args.userroledescription = row[1]
-                    if self.args.userrole not in self.roles:
-                        if not self.args.userroledescription:
-                            self.args.userroledescription = self.args.userrole
-                        req_payload = {
-                            "name": self.args.userrole,
-                            "description": self.args.userroledescription
-                        }
-                        resp = self.restclient.post(
-                            '/roles', json_body=json.dumps(req_payload)
-                        )
-                        if resp.status_code == 200:
-                            print colored('Role: \"%s\" successfully added'
-                                          % self.args.userrole, 'yellow')
-
-                    # Manage scope capabilities to assign to roles
-                    # Need to cleanup code a bit and maybe move around as this
-                    # may not be completely optimal
-                    if row[2]:
-                        self.args.appscopeshortname = row[2]
-                        self.get_app_scope()
-                        if self.app_scope_id is not None:
-                            if row[3]:
-                                resp = self.restclient.get(
-                                    '/roles'
-                                )
-                                if resp.status_code == 200:
-                                    python_data = json.loads(resp.text)
-                                    for key in python_data:
-                                        if key['name'] == row[0]:
-                                            req_payload = {
-                                                "app_scope_id":
-                                                self.app_scope_id,
-                                                "ability": row[3]
-                                            }
-                                            role_id = key['id']
-                                            resp = self.restclient.post(
-                                                '/roles/%s/capabilities'
-                                                % role_id,
-                                                json_body=json.dumps(
-                                                    req_payload)
-                                            )
-                                            if resp.status_code == 200:
-                                                print colored(
-                                                    'Capability successfully assigned',
-                                                    'yellow')
-                                            if resp.status_code == 400:
-                                                print colored(
-                                                    'Capablity already assigned',
-                                                    'yellow')
-
-                    else:
-                        print colored('User role: \"%s\" already exists'
-                                      % self.args.userrole,
-                                      'yellow')
-            finally:
-                f.close()
+            self.run_journaled(self.add_user_roles_row)
         else:
             if self.args.userrole not in self.roles:
                 if self.args.userroledescription is None:
@@ -260,8 +1764,70 @@ class Tetration(object):
                               % self.args.userrole,
                               'yellow')
 
+    def add_user_roles_row(self, row):
+        """Add a role and its scope capability from a CSV row."""
+        self.args.userrole = row[0]
+        self.args.userroledescription = row[1]
+        if self.args.userrole not in self.roles:
+            if not self.args.userroledescription:
+                self.args.userroledescription = self.args.userrole
+            req_payload = {
+                "name": self.args.userrole,
+                "description": self.args.userroledescription
+            }
+            resp = self.restclient.post(
+                '/roles', json_body=json.dumps(req_payload)
+            )
+            if resp.status_code != 200:
+                return False
+            print colored('Role: \"%s\" successfully added'
+                          % self.args.userrole, 'yellow')
+
+        # Manage scope capabilities to assign to roles
+        # Need to cleanup code a bit and maybe move around as this
+        # may not be completely optimal
+        if row[2]:
+            scope = self.find_app_scope(row[2])
+            if scope is not None:
+                if row[3]:
+                    resp = self.restclient.get(
+                        '/roles'
+                    )
+                    if resp.status_code == 200:
+                        python_data = json.loads(resp.text)
+                        for key in python_data:
+                            if key['name'] == row[0]:
+                                req_payload = {
+                                    "app_scope_id": scope['id'],
+                                    "ability": row[3]
+                                }
+                                role_id = key['id']
+                                resp = self.restclient.post(
+                                    '/roles/%s/capabilities' % role_id,
+                                    json_body=json.dumps(req_payload)
+                                )
+                                if resp.status_code == 200:
+                                    print colored(
+                                        'Capability successfully assigned',
+                                        'yellow')
+                                elif resp.status_code == 400:
+                                    print colored(
+                                        'Capablity already assigned',
+                                        'yellow')
+                                else:
+                                    return False
+        else:
+            print colored('User role: \"%s\" already exists'
+                          % self.args.userrole,
+                          'yellow')
+        return True
+
     def add_user_to_role(self):
-        """Add A User To A role."""
+        """
+        Add A User To A role.
+
+        Returns whether the user holds the role afterwards.
+        """
         # NEED to add ability defined more than one role ####
         self.get_user_roles()
         self.get_user()
@@ -273,51 +1839,27 @@ class Tetration(object):
                 endpoint = '/users/%s/add_role' % self.user_id
                 resp = self.restclient.put(
                     '%s' % endpoint, json_body=json.dumps(req_payload))
-                if resp.status_code == 200:
-                    print colored('User successfully assigned to role...',
-                                  'yellow')
+                if resp.status_code != 200:
+                    print colored('User not assigned to role %s, status %s'
+                                  % (self.args.userrole, resp.status_code),
+                                  'red')
+                    return False
+                print colored('User successfully assigned to role...',
+                              'yellow')
             else:
                 print colored('User already assigned role...Skipping',
                               'yellow')
-        else:
-            print colored('Role does not exist and user not added to role: ',
-                          'yellow') + self.args.userrole
+            return True
+        print colored('Role does not exist and user not added to role: ',
+                      'yellow') + self.args.userrole
+        return False
 
     def add_users(self):
         """Add Users."""
-        if self.args.readcsv is not None:
-            try:
-                f = open(self.args.readcsv)
-                csv_f = csv.reader(f)
-                next(csv_f, None)  # skip headers
-                for row in csv_f:
-                    self.args.useremail = row[0]
-                    self.args.userfirstname = row[1]
-                    self.args.userlastname = row[2]
-                    self.get_user()
-                    if self.user_id is not None:
-                        print colored('User already exists with ID: ',
-                                      'yellow') + self.user_id
-                    else:
-                        req_payload = {
-                            "first_name": self.args.userfirstname,
-                            "last_name": self.args.userlastname,
-                            "email": self.args.useremail
-                        }
-                        resp = self.restclient.post(
-                            '/users', json_body=json.dumps(req_payload))
-                        # if resp.status_code == 200:
-                        #     self.get_user()
-                        #     print colored('User successfully created with ID: ',
-                        #                   'yellow') + self.user_id
-                    self.get_user()
-                    if row[3]:
-                        for role in row[3].split(','):
-                            self.args.userrole = role
-                            # self.args.add_user_roles()
-                            self.add_user_to_role()
-            finally:
-                f.close()
+        if self.args.readcsv is not None and self.args.pipeline:
+            self.run_pipeline(self.add_users_mutate)
+        elif self.args.readcsv is not None:
+            self.run_journaled(self.add_users_row)
         else:
             self.get_user()
             if self.user_id is not None:
@@ -338,14 +1880,203 @@ class Tetration(object):
             if self.args.userrole is not None:
                 self.add_user_to_role()
 
+    def add_users_mutate(self, item):
+        """Pipeline stage creating a user and assigning its roles."""
+        user = item['user']
+        if user is None:
+            resp = self.restclient.post('/users', json_body=json.dumps({
+                "first_name": item['first_name'],
+                "last_name": item['last_name'],
+                "email": item['email']
+            }))
+            if resp.status_code != 200:
+                item['messages'].append(('User %s was not created, status %s'
+                                         % (item['email'], resp.status_code),
+                                         'red'))
+                return item
+            user = json.loads(resp.text)
+            item['messages'].append(('User successfully created with ID: %s'
+                                     % user['id'], 'yellow'))
+        else:
+            item['messages'].append(('User already exists with ID: %s'
+                                     % user['id'], 'yellow'))
+        for role_id in item['role_ids']:
+            if role_id in user.get('role_ids', []):
+                continue
+            resp = self.restclient.put(
+                '/users/%s/add_role' % user['id'],
+                json_body=json.dumps({"role_id": role_id}))
+            if resp.status_code != 200:
+                item['messages'].append(('User %s was not assigned role %s, '
+                                         'status %s' % (item['email'], role_id,
+                                                        resp.status_code),
+                                         'red'))
+                return item
+        item['ok'] = True
+        return item
+
+    def add_users_row(self, row):
+        """Add a user and assign its roles from a CSV row."""
+        self.args.useremail = row[0]
+        self.args.userfirstname = row[1]
+        self.args.userlastname = row[2]
+        self.get_user()
+        if self.user_id is not None:
+            print colored('User already exists with ID: ',
+                          'yellow') + self.user_id
+        else:
+            req_payload = {
+                "first_name": self.args.userfirstname,
+                "last_name": self.args.userlastname,
+                "email": self.args.useremail
+            }
+            resp = self.restclient.post(
+                '/users', json_body=json.dumps(req_payload))
+            if resp.status_code != 200:
+                return False
+            # if resp.status_code == 200:
+            #     self.get_user()
+            #     print colored('User successfully created with ID: ',
+            #                   'yellow') + self.user_id
+        self.get_user()
+        assigned = True
+        if len(row) > 3 and row[3]:
+            for role in row[3].split(','):
+                self.args.userrole = role
+                # self.args.add_user_roles()
+                if not self.add_user_to_role():
+                    assigned = False
+        return assigned
+
+    def bench_sensor_memory(self):
+        """
+        Benchmark Sensor Memory.
+
+        Compares the memory held by /sensors records as API dicts against
+        Sensor records, using --sensorsfile (saved get_sensors output) or
+        --benchcount mock sensors.
+        """
+        if self.args.sensorsfile is not None:
+            with open(self.args.sensorsfile) as infile:
+                python_data = json.load(infile)
+            if isinstance(python_data, dict):
+                python_data = python_data['results']
+        else:
+            python_data = mock_sensors(self.args.benchcount)
+        start = time.time()
+        records = [Sensor(key) for key in python_data]
+        elapsed = time.time() - start
+        dict_size = deep_getsizeof(python_data)
+        record_size = deep_getsizeof(records)
+        print 'Sensors:          %d' % len(records)
+        print 'Dict records:     %.1f MB (%d bytes/sensor)' % (
+            dict_size / 1048576.0, dict_size // max(len(records), 1))
+        print 'Sensor records:   %.1f MB (%d bytes/sensor)' % (
+            record_size / 1048576.0, record_size // max(len(records), 1))
+        print 'Reduction:        %.1fx' % (
+            float(dict_size) / max(record_size, 1))
+        print 'Build time:       %.3fs' % elapsed
+
+    def cleanup_sensors(self):
+        """
+        Clean Up Stale Sensors.
+
+        Streams the sensor inventory and selects sensors which have not
+        checked in for --staledays days and, with --duplicates, every sensor
+        of a host name except the one which checked in last. Sensors which
+        never checked in are aged from their creation, and sensors of
+        unknown age or without a host name are never selected. Selected
+        sensors are deleted concurrently at no more than --ratelimit
+        deletes per second, or only reported with --dryrun.
+        """
+        cutoff = None
+        if self.args.staledays is not None:
+            cutoff = time.time() - self.args.staledays * 86400
+        selected = {}
+        by_host_name = {}
+        scanned = 0
+        for key in self.iter_sensors():
+            sensor = Sensor(key)
+            if sensor.deleted_at is not None:
+                continue
+            scanned += 1
+            last_seen = sensor.last_config_fetch_at or sensor.created_at
+            if (cutoff is not None and last_seen is not None and
+                    last_seen < cutoff):
+                selected[sensor.uuid] = (sensor, 'stale')
+            if self.args.duplicates and sensor.host_name:
+                by_host_name.setdefault(sensor.host_name, []).append(sensor)
+        for sensors in by_host_name.itervalues():
+            sensors.sort(key=lambda sensor: (sensor.last_config_fetch_at or
+                                             sensor.created_at or 0),
+                         reverse=True)
+            for sensor in sensors[1:]:
+                selected.setdefault(sensor.uuid, (sensor, 'duplicate'))
+
+        limiter = RateLimiter(self.args.ratelimit)
+
+        def delete(item):
+            """DELETE a single sensor once the rate limit allows."""
+            sensor, reason = item
+            limiter.wait()
+            try:
+                resp = self.restclient.delete('/sensors/%s' % sensor.uuid)
+            except (TetrationError,
+                    requests.exceptions.RequestException) as err:
+                return sensor, reason, 'failed (%s)' % err
+            if resp.status_code in (200, 204):
+                return sensor, reason, 'deleted'
+            return sensor, reason, 'failed (status %s)' % resp.status_code
+
+        if self.args.dryrun:
+            results = ((sensor, reason, 'dry run')
+                       for sensor, reason in selected.itervalues())
+        else:
+            results = self.run_concurrent(delete, selected.values())
+        python_data = []
+        for sensor, reason, result in results:
+            last_check_in = ''
+            if sensor.last_config_fetch_at:
+                last_check_in = time.strftime(
+                    '%Y-%m-%dT%H:%M:%SZ',
+                    time.gmtime(sensor.last_config_fetch_at))
+            python_data.append({
+                "uuid": sensor.uuid, "host_name": sensor.host_name,
+                "last_check_in": last_check_in, "reason": reason,
+                "result": result
+            })
+        python_data.sort(key=lambda key: (key['host_name'],
+                                          key['last_check_in']))
+        results = [key['result'] for key in python_data]
+        sys.stderr.write(
+            'Scanned %d sensors: %d stale, %d duplicate, %d deleted, '
+            '%d failed\n'
+            % (scanned,
+               sum(1 for key in python_data if key['reason'] == 'stale'),
+               sum(1 for key in python_data if key['reason'] == 'duplicate'),
+               results.count('deleted'),
+               sum(1 for result in results if result.startswith('failed'))))
+        self.output_results(python_data)
+
     def create_app(self):
         """Create An Application."""
-        self.get_apps()
+        index = self.get_app_index()
+        if self.args.appscopeid is not None:
+            self.app_scope_id = self.args.appscopeid
+        else:
+            scope = self.find_app_scope(self.args.appscopeshortname)
+            if scope is None:
+                print colored('Application scope: \"%s\" does not exist...'
+                              % self.args.appscopeshortname, 'yellow')
+                return
+            self.app_scope_id = scope['id']
         if self.args.appdescription is None:
             appdescription = ""
         else:
             appdescription = self.args.appdescription
-        if self.app_name is None:
+        app = index['by_scope_name'].get((self.app_scope_id,
+                                          self.args.appname))
+        if app is None:
             req_payload = {
                 "app_scope_id": self.app_scope_id,
                 "name": self.args.appname,
@@ -355,22 +2086,29 @@ class Tetration(object):
             resp = self.restclient.post(
                 '/applications', json_body=json.dumps(req_payload))
             if resp.status_code == 200:
-                self.get_apps()
+                app = json.loads(resp.text)
+                self.app_id = app['id']
                 self.get_app()
                 print colored('Application successfully created....'
                               'Details above...', 'yellow')
         else:
+            self.app_id = app['id']
             self.get_app()
             print colored('Application already exists....Details above...',
                           'yellow')
 
     def delete_app(self):
         """Delete An Application."""
-        self.get_apps()
-        if self.app_name is not None:
+        index = self.get_app_index()
+        app = index['by_id'].get(self.args.appid)
+        if app is not None:
             resp = self.restclient.delete(
                 '/applications/%s' % self.args.appid)
             if resp.status_code == 200:
+                del index['by_id'][app['id']]
+                del index['by_scope_name'][(app['app_scope_id'], app['name'])]
+                index['by_scope'][app['app_scope_id']].remove(app)
+                index['all'].remove(app)
                 print colored('Application with id: %s'
                               % self.args.appid,
                               'yellow') + " successfully deleted..."
@@ -380,46 +2118,31 @@ class Tetration(object):
 
     def delete_sensor(self):
         """Delete A Sensor."""
-        self.get_sensors()
-        if self._sensor_info != {}:
-            if self.args.ip in self._sensor_info['ips']:
-                for _uuid in self._sensor_info['uuids']:
-                    resp = self.restclient.delete(
-                        '/sensors/%s' % _uuid
-                    )
-                    print resp
-                    if resp.status_code == 204:
-                        print colored(
-                            'Sensor %s with uuid: %s has been deleted'
-                            % (self.args.hostname, _uuid), 'yellow')
+        sensors = []
+        for sensor in self.get_sensor_index()['by_host_name'].get(
+                self.args.hostname, []):
+            if sensor.deleted_at is not None:
+                print "%s already deleted" % self.args.hostname
+            else:
+                sensors.append(sensor)
+        ip = ip_to_int(self.args.ip)
+        if any(ip in sensor.ipv4 for sensor in sensors):
+            for sensor in sensors:
+                resp = self.restclient.delete(
+                    '/sensors/%s' % sensor.uuid
+                )
+                print resp
+                if resp.status_code == 204:
+                    print colored(
+                        'Sensor %s with uuid: %s has been deleted'
+                        % (self.args.hostname, sensor.uuid), 'yellow')
 
     def delete_users(self):
         """Delete users."""
-        if self.args.readcsv is not None:
-            try:
-                f = open(self.args.readcsv)
-                csv_f = csv.reader(f)
-                next(csv_f, None)  # skip headers
-                for row in csv_f:
-                    self.args.useremail = row[0]
-                    self.args.userfirstname = row[1]
-                    self.args.userlastname = row[2]
-                    self.get_user()
-                    if self.user_id is not None:
-                        resp = self.restclient.delete(
-                            '/users/%s' % self.user_id)
-                        if resp.status_code == 200:
-                            print colored(
-                                'User %s %s %s with id: %s was deleted'
-                                % (self.args.userfirstname,
-                                   self.args.userlastname,
-                                   self.args.useremail,
-                                   self.user_id),
-                                'yellow')
-                    else:
-                        print colored('User does not exist', 'yellow')
-            finally:
-                f.close()
+        if self.args.readcsv is not None and self.args.pipeline:
+            self.run_pipeline(self.delete_users_mutate)
+        elif self.args.readcsv is not None:
+            self.run_journaled(self.delete_users_row)
         else:
             self.get_user()
             if self.user_id is not None:
@@ -436,86 +2159,300 @@ class Tetration(object):
             else:
                 print colored('User does not exist', 'yellow')
 
+    def delete_users_mutate(self, item):
+        """Pipeline stage deleting a user."""
+        if item['user'] is None:
+            item['messages'].append(('User %s does not exist' % item['email'],
+                                     'yellow'))
+        else:
+            resp = self.restclient.delete('/users/%s' % item['user']['id'])
+            if resp.status_code != 200:
+                item['messages'].append(('User %s was not deleted, status %s'
+                                         % (item['email'], resp.status_code),
+                                         'red'))
+                return item
+            item['messages'].append(('User %s with id: %s was deleted'
+                                     % (item['email'], item['user']['id']),
+                                     'yellow'))
+        item['ok'] = True
+        return item
+
+    def delete_users_row(self, row):
+        """Delete a user from a CSV row."""
+        self.args.useremail = row[0]
+        self.args.userfirstname = row[1]
+        self.args.userlastname = row[2]
+        self.get_user()
+        if self.user_id is not None:
+            resp = self.restclient.delete(
+                '/users/%s' % self.user_id)
+            if resp.status_code != 200:
+                return False
+            print colored(
+                'User %s %s %s with id: %s was deleted'
+                % (self.args.userfirstname,
+                   self.args.userlastname,
+                   self.args.useremail,
+                   self.user_id),
+                'yellow')
+        else:
+            print colored('User does not exist', 'yellow')
+        return True
+
+    def diff_app_clusters(self):
+        """
+        Diff Application Clusters.
+
+        Compares two get_app_clusters outputs. Clusters are fingerprinted by
+        their sorted member set so identical clusters are matched with a
+        hash join, and the remainder are paired up through a member to
+        cluster index by largest overlap.
+        """
+        old_apps = self.read_app_clusters(self.args.difffiles[0])
+        new_apps = self.read_app_clusters(self.args.difffiles[1])
+        python_data = {}
+        for app_id in sorted(set(old_apps) | set(new_apps)):
+            python_data[app_id] = self.diff_clusters(old_apps.get(app_id, []),
+                                                     new_apps.get(app_id, []))
+            sys.stderr.write(
+                '%s: %d unchanged, %d changed, %d added, %d removed\n'
+                % (app_id, python_data[app_id]['unchanged'],
+                   len(python_data[app_id]['changed']),
+                   len(python_data[app_id]['added']),
+                   len(python_data[app_id]['removed'])))
+        self.output_results(python_data)
+
+    def diff_clusters(self, old_clusters, new_clusters):
+        """Diff two lists of clusters for a single application."""
+        old_members = [cluster_members(cluster) for cluster in old_clusters]
+        new_members = [cluster_members(cluster) for cluster in new_clusters]
+        new_by_fingerprint = {}
+        for i, members in enumerate(new_members):
+            new_by_fingerprint.setdefault(
+                cluster_fingerprint(members), []).append(i)
+        unchanged = 0
+        old_unmatched = []
+        new_matched = set()
+        for i, members in enumerate(old_members):
+            candidates = new_by_fingerprint.get(cluster_fingerprint(members))
+            if candidates:
+                new_matched.add(candidates.pop())
+                unchanged += 1
+            else:
+                old_unmatched.append(i)
+
+        # Pair up the remaining clusters by member overlap.
+        member_index = {}
+        for i, members in enumerate(new_members):
+            if i not in new_matched:
+                for member in members:
+                    member_index[member] = i
+        changed = []
+        removed = []
+        for i in old_unmatched:
+            overlap = {}
+            for member in old_members[i]:
+                j = member_index.get(member)
+                if j is not None and j not in new_matched:
+                    overlap[j] = overlap.get(j, 0) + 1
+            if overlap:
+                j = max(overlap, key=overlap.get)
+                new_matched.add(j)
+                changed.append({
+                    "old_name": old_clusters[i].get('name'),
+                    "new_name": new_clusters[j].get('name'),
+                    "added_members": sorted(new_members[j] - old_members[i]),
+                    "removed_members": sorted(old_members[i] - new_members[j])
+                })
+            else:
+                removed.append({
+                    "name": old_clusters[i].get('name'),
+                    "members": sorted(old_members[i])
+                })
+        added = [{"name": new_clusters[j].get('name'),
+                  "members": sorted(new_members[j])}
+                 for j in range(len(new_clusters)) if j not in new_matched]
+        return {"unchanged": unchanged, "changed": changed, "added": added,
+                "removed": removed}
+
     # Need to finish this functionality. Currently only reads in a CSV...
     def create_app_scope(self):
         """Create An Application Scope."""
         if self.args.readcsv is not None:
+            self.run_journaled(self.create_app_scope_row)
+
+    def create_app_scope_row(self, row):
+        """Create an application scope from a CSV row."""
+        # We first capture the parent scope id to create scope under
+        parent_scope = self.find_app_scope(row[4])
+        if parent_scope is None:
+            print colored('Parent scope: \"%s\" does not exist' % row[4],
+                          'yellow')
+            return False
+        parent_scope_id = parent_scope['id']
+        #
+        # We now check the new scope does not already exist under the parent
+        children = self.get_scope_index()['children'].get(parent_scope_id, [])
+        if not any(child['short_name'] == row[0] for child in children):
+            req_payload = {
+                "short_name": row[0],
+                "short_query": {
+                    "type": row[2],
+                    "field": row[1],
+                    "value": row[3]
+                },
+                "parent_app_scope_id": parent_scope_id
+            }
+            resp = self.restclient.post(
+                '/app_scopes', json_body=json.dumps(req_payload))
+            if resp.status_code != 200:
+                return False
+            print "Successfully created app scope %s" % row[0]
+        else:
+            print "Already exists"
+
+        # We now need to check for any "Dirty" root scopes in order
+        # to commit the changes.
+        resp = self.restclient.get(
+            '/app_scopes/%s' % parent_scope_id
+        )
+        if resp.status_code == 200:
+            python_data = json.loads(resp.text)
+            if python_data['dirty']:
+                req_payload = {
+                    "root_app_scope_id": parent_scope_id
+                }
+                resp = self.restclient.post(
+                    '/app_scopes/commit_dirty',
+                    json_body=json.dumps(req_payload))
+                if resp.status_code == 201:
+                    print colored('Job queued', 'yellow')
+        return True
+
+    def create_inventory_filters(self):
+        """Create Inventory Filters From CSV Concurrently."""
+        index = self.get_filter_index()
+        req_payloads = []
+        try:
+            f = open(self.args.readcsv)
+            csv_f = csv.reader(f)
+            next(csv_f, None)  # skip headers
+            for line, row in enumerate(csv_f, 2):
+                if line in self.invalid_rows:
+                    continue
+                if (row[4], row[0]) in index['by_scope_name']:
+                    print colored('Filter: \"%s\" already exists in scope %s'
+                                  % (row[0], row[4]), 'yellow')
+                    continue
+                req_payloads.append({
+                    "name": row[0],
+                    "query": {
+                        "type": row[2],
+                        "field": row[1],
+                        "value": row[3]
+                    },
+                    "app_scope_id": row[4],
+                    "primary": len(row) > 5 and row[5].lower() == "true"
+                })
+        finally:
+            f.close()
+
+        def post_filter(req_payload):
+            """
+            POST a single inventory filter.
+
+            Returns the payload and None, or the reason it failed.
+            """
+            with self.tracer.span(self.args.action, 'csv') as args:
+                args['row'] = req_payload['name']
+                try:
+                    resp = self.restclient.post(
+                        '/filters/inventories',
+                        json_body=json.dumps(req_payload))
+                except (TetrationError,
+                        requests.exceptions.RequestException) as err:
+                    return req_payload, '%s' % err
+            if resp.status_code != 200:
+                return req_payload, 'status %s' % resp.status_code
+            return req_payload, None
+
+        for req_payload, error in self.run_concurrent(post_filter,
+                                                      req_payloads):
+            if error is not None:
+                print colored('Filter: \"%s\" failed with %s'
+                              % (req_payload['name'], error), 'red')
+                continue
+            print colored('Filter: \"%s\" successfully created'
+                          % req_payload['name'], 'yellow')
+
+    def fanout(self):
+        """
+        Run A Read Action Against Many Clusters.
+
+        Every cluster in --clustersfile is queried concurrently, following
+        the offset of paged collections, records are tagged with the name
+        of the cluster they came from and merged, and per-cluster timing is
+        reported on stderr.
+        """
+        with open(self.args.clustersfile) as infile:
+            clusters = json.load(infile)
+        endpoint = FANOUT_ENDPOINTS[self.args.action]
+
+        def fetch_cluster(cluster):
+            """GET every record of the endpoint from a single cluster."""
+            start = time.time()
             try:
-                f = open(self.args.readcsv)
-                csv_f = csv.reader(f)
-                next(csv_f, None)  # skip headers
-                for row in csv_f:
-                    # We first capture the parent scope id to create scope under
-                    parent_scope_shortname = row[4]
-                    self.args.appscopeshortname = parent_scope_shortname
-                    self.get_app_scope()
-                    parent_scope_id = self.app_scope_id
-                    #
-                    # We now capture the new scope to create
-                    self.args.appscopeshortname = row[0]
-                    self.get_app_scope()
-                    if (self.app_scope_id is None and
-                            parent_scope_id is not None):
-                        req_payload = {
-                            "short_name": row[0],
-                            "short_query": {
-                                "type": row[2],
-                                "field": row[1],
-                                "value": row[3]
-                            },
-                            "parent_app_scope_id": parent_scope_id
-                        }
-                        resp = self.restclient.post(
-                            '/app_scopes', json_body=json.dumps(req_payload))
-                        if resp.status_code == 200:
-                            print "Successfully created app scope %s" % row[0]
-                    else:
-                        print "Already exists"
+                restclient = ResilientRestClient(
+                    RestClient(cluster['apiendpoint'],
+                               credentials_file=cluster['credsfile'],
+                               verify=False, max_retries=0),
+                    self.args.connecttimeout, self.args.readtimeout,
+                    self.args.retries)
+                records = list(iter_records(restclient, endpoint))
+            except (IOError, TetrationError,
+                    requests.exceptions.RequestException) as err:
+                return cluster, None, err, time.time() - start
+            return cluster, records, None, time.time() - start
 
-                    # We now need to check for any "Dirty" root scopes in order
-                    # to commit the changes.
-                    resp = self.restclient.get(
-                        '/app_scopes/%s' % parent_scope_id
-                    )
-                    if resp.status_code == 200:
-                        python_data = json.loads(resp.text)
-                        if python_data['dirty']:
-                            req_payload = {
-                                "root_app_scope_id": parent_scope_id
-                            }
-                            resp = self.restclient.post(
-                                '/app_scopes/commit_dirty',
-                                json_body=json.dumps(req_payload))
-                            if resp.status_code == 201:
-                                print colored('Job queued', 'yellow')
-            finally:
-                f.close()
+        python_data = []
+        for cluster, records, err, elapsed in self.run_concurrent(
+                fetch_cluster, clusters):
+            if records is None:
+                sys.stderr.write('%s: failed in %.3fs: %s\n'
+                                 % (cluster['name'], elapsed, err))
+                continue
+            for key in records:
+                key['tetration_cluster'] = cluster['name']
+            python_data.extend(records)
+            sys.stderr.write('%s: %d records in %.3fs\n'
+                             % (cluster['name'], len(records), elapsed))
+        self.output_results(python_data)
 
     def get_app(self):
         """Capture Specific Application."""
-        if self.args.action == "create_app":
-            resp = self.restclient.get(
-                '/applications/%s/details' % self.app_id)
         if self.args.action == "get_app":
-            if self.args.appid is not None and self.args.appname is None:
-                resp = self.restclient.get(
-                    '/applications/%s/details' % self.args.appid)
-                if resp.status_code == 404:
-                    print colored('Application not found...', 'yellow')
-            if self.args.appid is None and self.args.appname is not None:
-                self.get_apps()
-                if self.app_id is not None:
-                    resp = self.restclient.get(
-                        '/applications/%s/details' % self.app_id)
-                else:
+            if self.args.appid is not None:
+                self.app_id = self.args.appid
+            else:
+                app = self.get_app_index()['by_scope_name'].get(
+                    (self.args.appscopeid, self.args.appname))
+                if app is None:
                     print colored('Application does not exist...', 'yellow')
                     return
+                self.app_id = app['id']
+        resp = self.restclient.get(
+            '/applications/%s/details' % self.app_id)
+        if resp.status_code == 404:
+            print colored('Application not found...', 'yellow')
         if resp.status_code == 200:
             python_data = json.loads(resp.text)
-            print json.dumps(python_data, indent=4)
+            self.output_results(python_data)
 
     def get_app_clusters(self):
         """Capture Specific Application."""
+        if self.args.appid is None:
+            self.get_apps_clusters()
+            return
         resp = self.restclient.get(
             '/applications/%s/details' % self.args.appid
         )
@@ -524,212 +2461,353 @@ class Tetration(object):
             _data = {}
             if 'clusters' in python_data:
                 _data.update({'Clusters': python_data['clusters']})
-                print json.dumps(_data, indent=4)
+                self.output_results(_data)
             else:
                 print colored('No clusters found for app!...Run ADM?',
                               'yellow')
 
+    def get_apps_clusters(self):
+        """
+        Capture Clusters For Many Applications.
+
+        Application details are fetched concurrently for --appids or for
+        every application in --appscopeid. Each application is written as
+        one JSON line to --savetofile (or stdout) as soon as it arrives and
+        per-application fetch latency is reported on stderr.
+        """
+        if self.args.appids is not None:
+            app_ids = [app_id.strip() for app_id in self.args.appids.split(',')
+                       if app_id.strip()]
+        else:
+            app_ids = [key['id'] for key in
+                       self.get_app_index()['by_scope'].get(
+                           self.args.appscopeid, [])]
+
+        def fetch_details(app_id):
+            """GET the details of a single application."""
+            start = time.time()
+            try:
+                resp = self.restclient.get('/applications/%s/details'
+                                           % app_id, store=False)
+            except (TetrationError,
+                    requests.exceptions.RequestException) as err:
+                return app_id, None, err, time.time() - start
+            return app_id, resp, None, time.time() - start
+
+        if self.args.savetofile:
+            outfile = open(self.args.savetofile, 'w')
+        else:
+            outfile = sys.stdout
+        latencies = []
+        try:
+            for app_id, resp, err, elapsed in self.run_concurrent(
+                    fetch_details, app_ids):
+                latencies.append(elapsed)
+                if resp is None:
+                    sys.stderr.write('%s: failed in %.3fs: %s\n'
+                                     % (app_id, elapsed, err))
+                    continue
+                if resp.status_code == 200:
+                    python_data = json.loads(resp.text)
+                    outfile.write(json.dumps({
+                        "app_id": app_id,
+                        "app_name": python_data.get('name'),
+                        "clusters": python_data.get('clusters', [])
+                    }) + '\n')
+                sys.stderr.write('%s: status %s in %.3fs\n'
+                                 % (app_id, resp.status_code, elapsed))
+        finally:
+            if outfile is not sys.stdout:
+                outfile.close()
+        if latencies:
+            latencies.sort()
+            sys.stderr.write(
+                'Fetched %d applications: min %.3fs, median %.3fs, '
+                'p95 %.3fs, max %.3fs\n'
+                % (len(latencies), latencies[0],
+                   latencies[len(latencies) // 2],
+                   latencies[int(len(latencies) * 0.95)],
+                   latencies[-1]))
+        else:
+            print colored('No applications found...', 'yellow')
+
+    def get_app_index(self):
+        """
+        Capture Application Index.
+
+        Applications are downloaded once per run and indexed by id, by app
+        scope id and by (app scope id, name).
+        """
+        if 'apps' not in self.cache:
+            index = {'all': [], 'by_id': {}, 'by_scope': {},
+                     'by_scope_name': {}}
+            resp = self.restclient.get('/applications')
+            if resp.status_code == 200:
+                for key in json.loads(resp.text):
+                    self.index_app(index, key)
+            self.cache['apps'] = index
+        return self.cache['apps']
+
     def get_apps(self):
         """Capture Applications."""
-        resp = self.restclient.get('/applications')
-        if resp.status_code == 200:
-            python_data = json.loads(resp.text)
-            if self.args.action == "create_app":
-                if (self.args.appscopeid is not None and
-                        self.args.appscopeshortname is None):
-                    for key in python_data:
-                        if (key['app_scope_id'] == self.args.appscopeid and
-                                key['name'] == self.args.appname):
-                            self.app_id = key['id']
-                            self.app_name = key['name']
-                            return
-                        else:
-                            self.app_name = None
-                            self.app_scope_id = self.args.appscopeid
-                if (self.args.appscopeid is None and
-                        self.args.appscopeshortname is not None):
-                    self.get_app_scopes()
-                    if self.app_scope_id is not None:
-                        for key in python_data:
-                            if (key['app_scope_id'] == self.app_scope_id and
-                                    key['name'] == self.args.appname):
-                                self.app_id = key['id']
-                                self.app_name = key['name']
-                                return
-                            else:
-                                self.app_name = None
-            if self.args.action == "delete_app":
-                for key in python_data:
-                    if key['id'] == self.args.appid:
-                        self.app_name = key['name']
-                        return
-                    else:
-                        self.app_name = None
-                return
-            if (self.args.action == "get_app" and
-                    self.args.appname is not None and
-                    self.args.appscopeid is not None):
-                for key in python_data:
-                    if (key['name'] == self.args.appname and
-                            key['app_scope_id'] == self.args.appscopeid):
-                        self.app_id = key['id']
-                        return
-                    else:
-                        self.app_id = None
-            else:
-                if self.args.savetofile:
-                    self.save_results(python_data)
-                else:
-                    if self.args.action != "create_app":
-                        print json.dumps(python_data, indent=4)
+        python_data = self.get_app_index()['all']
+        self.output_results(python_data)
 
     def get_app_scope(self):
         """Capture A Specific Application Scope."""
-        if (self.args.appscopeid is not None and
-                self.args.appscopeshortname is None):
+        if self.args.appscopeid is not None:
             resp = self.restclient.get('/app_scopes/%s' % self.args.appscopeid)
-        if (self.args.appscopeid is None and
-                self.args.appscopeshortname is not None):
-            self.get_app_scopes()
-            if self.app_scope_id is not None:
-                resp = self.restclient.get(
-                    '/app_scopes/%s' % self.app_scope_id)
+        else:
+            scope = self.find_app_scope(self.args.appscopeshortname)
+            if scope is not None:
+                resp = self.restclient.get('/app_scopes/%s' % scope['id'])
             else:
                 resp = None
-        if (self.args.action != "create_app_scope" and
-                self.args.action != "add_user_roles"):
-            if resp is not None:
-                if resp.status_code == 200:
-                    python_data = json.loads(resp.text)
-                    print json.dumps(python_data, indent=4)
-            else:
+        if resp is not None:
+            if resp.status_code == 200:
+                python_data = json.loads(resp.text)
+                self.output_results(python_data)
+        else:
+            print ("Application Scope Id or Application Scope Short Name "
+                   "Does Not Exist!...")
+
+    def get_app_scope_tree(self):
+        """Capture Application Scope Tree."""
+        index = self.get_scope_index()
+        if (self.args.appscopeid is not None or
+                self.args.appscopeshortname is not None):
+            scope = self.find_app_scope(self.args.appscopeid or
+                                        self.args.appscopeshortname)
+            if scope is None:
                 print ("Application Scope Id or Application Scope Short Name "
                        "Does Not Exist!...")
+                return
+            ancestors = [ancestor['short_name'] for ancestor in
+                         self.iter_scope_ancestors(scope)]
+            if ancestors:
+                print colored('Ancestors: %s'
+                              % ' > '.join(reversed(ancestors)), 'yellow')
+            roots = [scope]
+        else:
+            roots = index['roots']
+        for root in roots:
+            for scope, depth in self.iter_scope_descendants(root):
+                print '%s%s (%s)' % ('    ' * depth, scope['short_name'],
+                                     scope['id'])
 
     def get_app_scopes(self):
         """Capture Application Scopes."""
-        resp = self.restclient.get('/app_scopes')
-        if resp.status_code == 200:
-            python_data = json.loads(resp.text)
-            if (self.args.action == "create_app" or
-                    self.args.action == "create_app_scope" or
-                    self.args.action == "get_app_scope" or
-                    self.args.action == "add_user_roles"):
-                if (self.args.appscopeid is None and
-                        self.args.appscopeshortname is not None):
-                    for key in python_data:
-                        if key['short_name'] == self.args.appscopeshortname:
-                            self.app_scope_id = key['id']
-                            return
-                        else:
-                            self.app_scope_id = None
-            else:
-                if self.args.savetofile:
-                    self.save_results(python_data)
-                else:
-                    print json.dumps(python_data, indent=4)
+        python_data = self.get_scope_index()['all']
+        self.output_results(python_data)
+
+    def get_scope_index(self):
+        """
+        Capture Application Scope Tree Index.
+
+        Scopes are downloaded once per run and indexed by id, by full name,
+        by short name and by parent scope id, so ancestors and descendants
+        can be walked without scanning the flat list.
+        """
+        if 'scopes' not in self.cache:
+            index = {'all': [], 'roots': [], 'by_id': {}, 'by_name': {},
+                     'by_short_name': {}, 'children': {}}
+            resp = self.restclient.get('/app_scopes')
+            if resp.status_code == 200:
+                for key in json.loads(resp.text):
+                    self.index_scope(index, key)
+            self.cache['scopes'] = index
+        return self.cache['scopes']
 
     def get_flow_dimensions(self):
         """Capture Flow Dimensions."""
         resp = self.restclient.get('/flowsearch/dimensions')
         if resp.status_code == 200:
             python_data = json.loads(resp.text)
-            if self.args.savetofile:
-                self.save_results(python_data)
-            else:
-                print json.dumps(python_data, indent=4)
+            self.output_results(python_data)
 
     def get_flow_metrics(self):
         """Capture Flow Metrics."""
         resp = self.restclient.get('/flowsearch/metrics')
         if resp.status_code == 200:
             python_data = json.loads(resp.text)
-            if self.args.savetofile:
-                self.save_results(python_data)
-            else:
-                print json.dumps(python_data, indent=4)
+            self.output_results(python_data)
 
     def get_inventory_dimensions(self):
         """Capture Inventory Dimensions."""
         resp = self.restclient.get('/inventory/search/dimensions')
         if resp.status_code == 200:
             python_data = json.loads(resp.text)
-            if self.args.savetofile:
-                self.save_results(python_data)
-            else:
-                print json.dumps(python_data, indent=4)
+            self.output_results(python_data)
+
+    def get_filter_index(self):
+        """
+        Capture Inventory Filter Index.
+
+        Filters are downloaded once per run and indexed by id, by app scope
+        id, by name and by (app scope id, name).
+        """
+        if 'filters' not in self.cache:
+            index = {'all': [], 'by_id': {}, 'by_scope': {}, 'by_name': {},
+                     'by_scope_name': {}}
+            resp = self.restclient.get('/filters/inventories')
+            if resp.status_code == 200:
+                for key in json.loads(resp.text):
+                    self.index_filter(index, key)
+            self.cache['filters'] = index
+        return self.cache['filters']
+
+    def get_inventory_filter(self):
+        """Capture A Specific Inventory Filter."""
+        index = self.get_filter_index()
+        if self.args.filterid is not None:
+            data = index['by_id'].get(self.args.filterid)
+        elif self.args.appscopeid is not None:
+            data = index['by_scope_name'].get(
+                (self.args.appscopeid, self.args.filtername))
+        else:
+            data = index['by_name'].get(self.args.filtername)
+        if data:
+            self.output_results(data)
+        else:
+            print colored('Inventory filter not found...', 'yellow')
 
     def get_inventory_filters(self):
         """Capture Inventory Filters."""
-        resp = self.restclient.get('/filters/inventories')
-        if resp.status_code == 200:
-            python_data = json.loads(resp.text)
-            if self.args.appscopeid is not None:
-                data = []
-                for key in python_data:
-                    if key['app_scope_id'] == self.args.appscopeid:
-                        data.append(key)
-                print json.dumps(data, indent=4)
+        index = self.get_filter_index()
+        if self.args.appscopeid is not None:
+            python_data = index['by_scope'].get(self.args.appscopeid, [])
+        else:
+            python_data = index['all']
+        self.output_results(python_data)
+
+    def find_app_scope(self, name):
+        """
+        Resolve an application scope.
+
+        name may be a scope id, a full name (colon or dot separated) or a
+        short name. Short names shared by several scopes are reported as
+        ambiguous and resolve to None.
+        """
+        index = self.get_scope_index()
+        scope = (index['by_id'].get(name) or index['by_name'].get(name) or
+                 index['by_name'].get(name.replace('.', ':')))
+        if scope is not None:
+            return scope
+        scopes = index['by_short_name'].get(name, [])
+        if len(scopes) > 1:
+            print colored('Application scope short name \"%s\" is ambiguous, '
+                          'use one of: %s'
+                          % (name, ', '.join(key['name'] for key in scopes)),
+                          'yellow')
+            return None
+        return scopes[0] if scopes else None
+
+    def get_role_members(self):
+        """
+        Capture The User Role Membership Matrix.
+
+        The matrix is built from one /users and one /roles call as a bitmap
+        of member users per role. Outputs one record per membership, the
+        users holding any or all (--match) of --roles, or with --emptyroles
+        the roles without members.
+        """
+        users = self.get_user_index()['all']
+        roles = self.get_role_index()
+        positions = dict((role_id, []) for role_id in roles['by_id'])
+        for i, user in enumerate(users):
+            for role_id in user.get('role_ids', []):
+                positions.setdefault(role_id, []).append(i)
+        bitmaps = dict((role_id, positions_bitmap(role_positions, len(users)))
+                       for role_id, role_positions in positions.iteritems())
+        sys.stderr.write('Membership matrix: %d users x %d roles, %d '
+                         'memberships\n'
+                         % (len(users), len(bitmaps),
+                            sum(len(role_positions) for role_positions
+                                in positions.itervalues())))
+        if self.args.emptyroles:
+            python_data = [key for key in roles['all']
+                           if not bitmaps[key['id']]]
+        elif self.args.roles is not None:
+            role_ids = []
+            for name in self.args.roles.split(','):
+                role = (roles['by_name'].get(name.strip()) or
+                        roles['by_id'].get(name.strip()))
+                if role is None:
+                    print colored('Role does not exist: %s' % name.strip(),
+                                  'yellow')
+                    return
+                role_ids.append(role['id'])
+            if self.args.match == 'all':
+                matched = (1 << len(users)) - 1
+                for role_id in role_ids:
+                    matched &= bitmaps[role_id]
             else:
-                if self.args.savetofile:
-                    self.save_results(python_data)
-                else:
-                    print json.dumps(python_data, indent=4)
+                matched = 0
+                for role_id in role_ids:
+                    matched |= bitmaps[role_id]
+            python_data = []
+            for i in bitmap_positions(matched):
+                user = users[i]
+                python_data.append({
+                    "id": user['id'], "email": user['email'],
+                    "first_name": user.get('first_name'),
+                    "last_name": user.get('last_name'),
+                    "roles": [roles['by_id'][role_id]['name']
+                              for role_id in role_ids
+                              if bitmaps[role_id] >> i & 1]
+                })
+        else:
+            python_data = [
+                {"user_id": user['id'], "email": user['email'],
+                 "role_id": role_id,
+                 "role_name": roles['by_id'].get(role_id, {}).get('name')}
+                for user in users for role_id in user.get('role_ids', [])]
+        self.output_results(python_data)
 
     def get_sensor(self):
         """Get A Sensor."""
         self.get_sensors()
 
+    def get_sensor_index(self):
+        """
+        Capture Sensor Index.
+
+        Sensors are downloaded once per run as compact Sensor records and
+        indexed by uuid and by host name.
+        """
+        if 'sensors' not in self.cache:
+            index = {'all': [], 'by_uuid': {}, 'by_host_name': {}}
+            for key in self.iter_sensors():
+                self.index_sensor(index, key)
+            self.cache['sensors'] = index
+        return self.cache['sensors']
+
     def get_sensors(self):
-        """Capture Sensors."""
-        resp = self.restclient.get('/sensors')
-        if resp.status_code == 200:
-            python_data = json.loads(resp.text)
-            if self.args.action == "delete_sensor":
-                _ips = []
-                _uuids = []
-                self._sensor_info = {}
-                for key in python_data['results']:
-                    if key['host_name'] == self.args.hostname:
-                        if "deleted_at" in key:
-                            print "%s already deleted" % self.args.hostname
-                        else:
-                            self._sensor_info['host_name'] = key['host_name']
-                            for _int in key['interfaces']:
-                                if (_int['family_type'] == "IPV4" and
-                                        _int['ip'] != "127.0.0.1"):
-                                    if _int['ip'] not in _ips:
-                                        _ips.append(_int['ip'])
-                            if key['uuid'] not in _uuids:
-                                _uuids.append(key['uuid'])
-                self._sensor_info.update({"ips": _ips})
-                self._sensor_info.update({"uuids": _uuids})
-                return
-            if self.args.action == "get_sensor":
-                for key in python_data['results']:
-                    if key['host_name'] == self.args.hostname:
-                        print json.dumps(key, indent=4)
-                return
-            else:
-                if self.args.savetofile:
-                    self.save_results(python_data)
-                else:
-                    print json.dumps(python_data, indent=4)
+        """
+        Capture Sensors.
+
+        Sensors are output page by page as they are fetched, so the first
+        records are printed before the whole inventory is downloaded.
+        """
+        records = self.iter_sensors()
+        if self.args.action == "get_sensor":
+            records = (key for key in records
+                       if key['host_name'] == self.args.hostname)
+        self.output_results(records)
 
     def get_switches(self):
         """Capture Switches."""
         resp = self.restclient.get('/switches')
         if resp.status_code == 200:
             python_data = json.loads(resp.text)
-            if self.args.savetofile:
-                self.save_results(python_data)
-            else:
-                print json.dumps(python_data, indent=4)
+            self.output_results(python_data)
 
     def get_user(self):
         """Capture Users."""
+        self.user_id = None
+        self.user_role_ids = []
         resp = self.restclient.get('/users')
-        if resp.status_code == 200:
+        if resp.status_code == 200 and self.args.useremail:
             python_data = json.loads(resp.text)
             for key in python_data:
                 if (key['first_name'] == self.args.userfirstname and
@@ -756,10 +2834,7 @@ class Tetration(object):
                     self.roles.append(key['name'])
                 return
             if self.args.action == "get_user_roles":
-                if self.args.savetofile:
-                    self.save_results(python_data)
-                else:
-                    print json.dumps(python_data, indent=4)
+                self.output_results(python_data)
             else:
                 for key in python_data:
                     if self.args.userrole is None:
@@ -771,22 +2846,208 @@ class Tetration(object):
                         else:
                             self.user_role_id = None
 
+    def get_role_index(self):
+        """
+        Capture Role Index.
+
+        Roles are downloaded once per run and indexed by id and by name.
+        """
+        if 'roles' not in self.cache:
+            index = {'all': [], 'by_id': {}, 'by_name': {}}
+            resp = self.restclient.get('/roles')
+            if resp.status_code == 200:
+                for key in json.loads(resp.text):
+                    self.index_role(index, key)
+            self.cache['roles'] = index
+        return self.cache['roles']
+
+    def get_user_index(self):
+        """
+        Capture User Index.
+
+        Users are downloaded once per run and indexed by id and by lower
+        case email.
+        """
+        if 'users' not in self.cache:
+            index = {'all': [], 'by_id': {}, 'by_email': {}}
+            resp = self.restclient.get('/users')
+            if resp.status_code == 200:
+                for key in json.loads(resp.text):
+                    self.index_user(index, key)
+            self.cache['users'] = index
+        return self.cache['users']
+
     def get_users(self):
         """Capture Users."""
         resp = self.restclient.get('/users')
         if resp.status_code == 200:
             python_data = json.loads(resp.text)
-            if self.args.savetofile:
-                self.save_results(python_data)
-            else:
-                print json.dumps(python_data, indent=4)
+            self.output_results(python_data)
+
+    def get_vrf_inventory(self):
+        """
+        Capture Per-VRF Inventory.
+
+        VRFs, switches and sensors are fetched concurrently and joined on
+        VRF id through a hash index of the VRFs, so every record is looked
+        at once. Sensors belong to the VRFs of their IPv4 interfaces.
+        Members of VRF ids missing from /vrfs are reported under those ids
+        without a name.
+        """
+        def fetch(name):
+            """GET a collection, or the sensor index for sensors."""
+            if name == 'sensors':
+                return name, self.get_sensor_index()['all']
+            resp = self.restclient.get('/%s' % name)
+            if resp.status_code != 200:
+                raise TetrationError('GET /%s returned status %s'
+                                     % (name, resp.status_code))
+            return name, json.loads(resp.text)
+
+        collections = {}
+        for name, records in self.run_concurrent(
+                fetch, ['sensors', 'switches', 'vrfs']):
+            collections[name] = records
+        index = {}
+
+        def vrf_entry(vrf_id, name=None):
+            """Return the report entry of a VRF id, adding it when new."""
+            if vrf_id not in index:
+                index[vrf_id] = {"vrf_id": vrf_id, "name": name,
+                                 "sensors": [], "switches": []}
+            return index[vrf_id]
+
+        for key in collections['vrfs']:
+            vrf_entry(key['id'], key.get('name'))
+        for sensor in collections['sensors']:
+            if sensor.deleted_at is not None:
+                continue
+            for vrf_id in set(sensor.ipv4_vrf_ids):
+                vrf_entry(vrf_id)['sensors'].append(sensor.host_name)
+        for key in collections['switches']:
+            vrf_entry(key.get('vrf_id'))['switches'].append(
+                key.get('name') or key.get('ip'))
+        python_data = []
+        for vrf_id in sorted(index):
+            entry = index[vrf_id]
+            entry['sensors'].sort()
+            entry['switches'].sort()
+            entry['sensor_count'] = len(entry['sensors'])
+            entry['switch_count'] = len(entry['switches'])
+            python_data.append(entry)
+        self.output_results(python_data)
 
     def get_vrfs(self):
         """Capture VRFs."""
         resp = self.restclient.get('/vrfs')
         if resp.status_code == 200:
             python_data = json.loads(resp.text)
-            print json.dumps(python_data, indent=4)
+            self.output_results(python_data)
+
+    def index_app(self, index, key):
+        """Add an application to the application index."""
+        index['all'].append(key)
+        index['by_id'][key['id']] = key
+        index['by_scope'].setdefault(key['app_scope_id'], []).append(key)
+        index['by_scope_name'][(key['app_scope_id'], key['name'])] = key
+
+    def index_filter(self, index, key):
+        """Add an inventory filter to the filter index."""
+        index['all'].append(key)
+        index['by_id'][key['id']] = key
+        index['by_scope'].setdefault(key['app_scope_id'], []).append(key)
+        index['by_name'].setdefault(key['name'], []).append(key)
+        index['by_scope_name'][(key['app_scope_id'], key['name'])] = key
+
+    def index_role(self, index, key):
+        """Add a role to the role index."""
+        index['all'].append(key)
+        index['by_id'][key['id']] = key
+        index['by_name'][key['name']] = key
+
+    def index_scope(self, index, key):
+        """Add an application scope to the scope tree index."""
+        index['all'].append(key)
+        index['by_id'][key['id']] = key
+        index['by_name'][key.get('name')] = key
+        index['by_short_name'].setdefault(key['short_name'], []).append(key)
+        if key.get('parent_app_scope_id'):
+            index['children'].setdefault(key['parent_app_scope_id'],
+                                         []).append(key)
+        else:
+            index['roots'].append(key)
+
+    def index_sensor(self, index, key):
+        """Add a /sensors API record to the sensor index."""
+        sensor = Sensor(key)
+        index['all'].append(sensor)
+        index['by_uuid'][sensor.uuid] = sensor
+        index['by_host_name'].setdefault(sensor.host_name, []).append(sensor)
+
+    def index_user(self, index, key):
+        """Add a user to the user index."""
+        index['all'].append(key)
+        index['by_id'][key['id']] = key
+        index['by_email'][key['email'].lower()] = key
+
+    def invalidate_indexes(self, uri_path, method, resp):
+        """
+        Keep in-memory indexes in step with a mutated collection.
+
+        Rejected requests change nothing. Items created by a POST to the
+        collection are added from the response, deleted items are removed,
+        and actions on an item or the whole collection (add_role,
+        commit_dirty) keep the ids, names and parents indexed. An index is
+        only dropped when it can no longer be trusted: the outcome is
+        unknown, an item was updated in place, or a created item cannot be
+        read from the response.
+        """
+        collection = collection_path(uri_path)
+        segments = [segment for segment in
+                    uri_path[len(collection):].split('/') if segment]
+        with self.index_lock:
+            for name, index_collection in INDEX_COLLECTIONS.items():
+                index = self.cache.get(name)
+                if index_collection != collection or index is None:
+                    continue
+                if resp is not None and 400 <= resp.status_code < 500:
+                    continue
+                if resp is None or not 200 <= resp.status_code < 300:
+                    del self.cache[name]
+                elif not segments and method == 'post':
+                    try:
+                        key = json.loads(resp.text)
+                    except ValueError:
+                        key = None
+                    if isinstance(key, dict) and 'id' in key:
+                        getattr(self, 'index_%s' % name[:-1])(index, key)
+                    else:
+                        del self.cache[name]
+                elif len(segments) == 1 and method == 'delete':
+                    record = index.get('by_id', index.get('by_uuid',
+                                                          {})).get(segments[0])
+                    if record is not None:
+                        unindex(index, record)
+                elif len(segments) == 1 and method != 'post':
+                    del self.cache[name]
+
+    def read_csv_chunks(self):
+        """
+        Read --readcsv in chunks of --chunksize rows.
+
+        Rows on the lines preflight found invalid are left out.
+        """
+        with open(self.args.readcsv) as f:
+            csv_f = csv.reader(f)
+            next(csv_f, None)  # skip headers
+            rows = enumerate(csv_f, 2)
+            while True:
+                with self.phases.phase('parse'):
+                    chunk = list(itertools.islice(rows, self.args.chunksize))
+                if not chunk:
+                    return
+                yield [row for line, row in chunk
+                       if line not in self.invalid_rows]
 
     def read_cli_args(self):
         """
@@ -799,14 +3060,19 @@ class Tetration(object):
         parser.add_argument(
             'action', help='Define action to take',
             choices=['add_user_roles', 'add_users', 'add_user_to_role',
-                     'create_app', 'create_app_scope', 'delete_app',
-                     'delete_sensor', 'delete_users', 'get_app',
-                     'get_app_clusters', 'get_apps', 'get_app_scope',
+                     'bench_sensor_memory', 'cleanup_sensors', 'create_app',
+                     'create_app_scope', 'create_inventory_filters',
+                     'delete_app', 'delete_sensor', 'delete_users',
+                     'diff_app_clusters', 'get_app', 'get_app_clusters',
+                     'get_apps', 'get_app_scope', 'get_app_scope_tree',
                      'get_app_scopes', 'get_flow_dimensions',
                      'get_flow_metrics', 'get_inventory_dimensions',
-                     'get_inventory_filters', 'get_switches', 'get_user_roles',
+                     'get_inventory_filter', 'get_inventory_filters',
+                     'get_role_members', 'get_switches', 'get_user_roles',
                      'get_sensor', 'get_sensors', 'get_user', 'get_users',
-                     'get_vrfs', 'remove_user_from_role'])
+                     'get_vrf_inventory', 'get_vrfs', 'match_sensor_subnets',
+                     'preview_app_scopes', 'query', 'remove_user_from_role',
+                     'sensor_stats', 'sync', 'update_user_roles', 'watch'])
         parser.add_argument(
             '--apiendpoint', help='Tetration API Endpoint', required=False,
             default='https://172.16.5.4')
@@ -820,6 +3086,9 @@ class Tetration(object):
             '--appname', help='Application Name', required=False)
         parser.add_argument(
             '--appid', help='Application Id', required=False)
+        parser.add_argument(
+            '--appids', help='Comma separated list of Application Ids',
+            required=False)
         parser.add_argument(
             '--appscopeid', help='Application Scope Id', required=False)
         parser.add_argument(
@@ -828,18 +3097,136 @@ class Tetration(object):
         parser.add_argument(
             '--appscopeprimary', help='Application Scope Primary(True|False)',
             required=False, default=False)
+        parser.add_argument(
+            '--benchcount', help='Number of mock sensors to benchmark',
+            required=False, type=int, default=100000)
+        parser.add_argument(
+            '--cachedir', help='Directory for the persistent HTTP cache',
+            required=False, default=os.path.join('~', '.tetration_cache'))
+        parser.add_argument(
+            '--cachesize', help='Maximum size of the persistent HTTP cache '
+            'in MB', required=False, type=int, default=64)
+        parser.add_argument(
+            '--chunksize', help='Number of CSV rows to read at a time',
+            required=False, type=int, default=1000)
+        parser.add_argument(
+            '--clustersfile',
+            help='JSON file listing clusters (name, apiendpoint, credsfile) '
+                 'to run a read action against concurrently',
+            required=False)
+        parser.add_argument(
+            '--columns', help='Comma separated record fields to show with '
+            '--output table or csv', required=False)
+        parser.add_argument(
+            '--connecttimeout', help='Seconds to wait for an API connection',
+            required=False, type=float, default=5)
         parser.add_argument(
             '--credsfile', help='Path To Credentials file', required=False,
             default="~\\downloads\\api_credentials.json")
+        parser.add_argument(
+            '--dbfile', help='SQLite file of the sync mirror',
+            required=False, default=os.path.join('~', '.tetration.db'))
+        parser.add_argument(
+            '--difffiles', help='Old and new get_app_clusters output files',
+            nargs=2, metavar=('OLD', 'NEW'), required=False)
+        parser.add_argument(
+            '--dryrun', help='Report what cleanup_sensors would delete '
+            'without deleting it', action='store_true')
+        parser.add_argument(
+            '--duplicates', help='Select all but the latest sensor of each '
+            'host name for cleanup_sensors', action='store_true')
+        parser.add_argument(
+            '--emptyroles', help='Only show roles without members with '
+            'get_role_members', action='store_true')
+        parser.add_argument(
+            '--filterid', help='Inventory Filter Id', required=False)
+        parser.add_argument(
+            '--filtername', help='Inventory Filter Name', required=False)
         parser.add_argument(
             '--hostname', help='Sensor host name'
         )
+        parser.add_argument(
+            '--inventoryfile', help='Saved inventory search results to read',
+            required=False)
+        parser.add_argument(
+            '--interval', help='Seconds between watch polls',
+            required=False, type=float, default=60)
         parser.add_argument(
             '--ip', help='IP address', required=False
         )
+        parser.add_argument(
+            '--journal',
+            help='Journal file recording completed CSV rows so an '
+                 'interrupted run can be resumed', required=False)
+        parser.add_argument(
+            '--match', help='Whether get_role_members --roles matches users '
+            'with any or all of the roles', choices=['any', 'all'],
+            default='any')
+        parser.add_argument(
+            '--no-cache', help='Bypass the persistent HTTP cache',
+            action='store_true', dest='no_cache')
+        parser.add_argument(
+            '--onerror', help='What to do when the pre-flight validation of '
+            'a bulk CSV finds invalid rows', choices=['abort', 'skip'],
+            default='abort')
+        parser.add_argument(
+            '--pipeline', help='Run bulk CSV actions as a staged pipeline '
+            'with concurrent mutations', action='store_true')
+        parser.add_argument(
+            '--output', help='Output format for results (default: json, '
+            'indented on a terminal and compact when piped)', required=False,
+            choices=['csv', 'json', 'ndjson', 'table'], default='json')
+        parser.add_argument(
+            '--polls', help='Number of watch polls (default: until '
+            'interrupted)', required=False, type=int, default=0)
+        parser.add_argument(
+            '--profile', help='Run the action under cProfile, write pstats '
+            'to this file and report time per phase', required=False)
+        parser.add_argument(
+            '--queryname', help='Named lookup for the query action',
+            required=False, choices=sorted(MIRROR_QUERIES))
+        parser.add_argument(
+            '--ratelimit', help='Maximum deletes per second for '
+            'cleanup_sensors (0 for no limit)', required=False, type=float,
+            default=10)
         parser.add_argument('--readcsv', help='Read input from CSV')
+        parser.add_argument(
+            '--readtimeout', help='Seconds to wait for an API response '
+            '(slower endpoints wait at least 60 or 120)', required=False,
+            type=float, default=30)
+        parser.add_argument(
+            '--refresh', help='Ignore persistent HTTP cache entries and '
+            'fetch fresh copies', action='store_true')
+        parser.add_argument(
+            '--retries', help='Times to retry a failed API request',
+            required=False, type=int, default=3)
+        parser.add_argument(
+            '--roles', help='Comma separated role names or ids for '
+            'get_role_members', required=False)
         parser.add_argument(
             '--savetofile', help='Define file to save results to')
+        parser.add_argument(
+            '--sensorsfile', help='Saved get_sensors output to read',
+            required=False)
+        parser.add_argument(
+            '--sql', help='Read-only SQL statement for the query action',
+            required=False)
+        parser.add_argument(
+            '--staledays', help='Select sensors which have not checked in '
+            'for this many days for cleanup_sensors', required=False,
+            type=float)
+        parser.add_argument(
+            '--subnets', help='Comma separated list of CIDRs',
+            required=False)
+        parser.add_argument(
+            '--subnetsfile', help='File with one CIDR per line',
+            required=False)
+        parser.add_argument(
+            '--tables', help='Comma separated mirror tables to sync '
+            '(default: all)', required=False)
+        parser.add_argument(
+            '--trace', help='Write a Chrome trace event JSON file of every '
+            'API call and CSV row', required=False)
         parser.add_argument(
             '--useremail', help='User email', required=False)
         parser.add_argument(
@@ -852,9 +3239,16 @@ class Tetration(object):
             '--userroledescription', help='Role name description',
             required=False
         )
+        parser.add_argument(
+            '--validateonly', help='Only run the pre-flight validation of a '
+            'bulk CSV', action='store_true')
         parser.add_argument(
             '--vrf', help='VRF Name', required=False
         )
+        parser.add_argument(
+            '--workers', help='Number of concurrent API requests',
+            required=False, type=int, default=8
+        )
 
         self.args = parser.parse_args()
         # if self.args.action == "add_user_to_role":
@@ -867,6 +3261,9 @@ class Tetration(object):
                     parser.error(
                         '--userfirstname and --userlastname and '
                         '--useremail ARE REQUIRED!')
+        if self.args.action == "cleanup_sensors":
+            if self.args.staledays is None and not self.args.duplicates:
+                parser.error('--staledays or --duplicates is REQUIRED!')
         if self.args.action == "delete_sensor":
             if (self.args.hostname is None or
                     self.args.ip is None):
@@ -898,9 +3295,13 @@ class Tetration(object):
             if (self.args.appname is not None and
                     self.args.appid is None and self.args.appscopeid is None):
                 parser.error('--appscopeid is REQUIRED when using --appname!')
+        if self.args.action == "diff_app_clusters":
+            if self.args.difffiles is None:
+                parser.error('--difffiles is REQUIRED!')
         if self.args.action == "get_app_clusters":
-            if self.args.appid is None:
-                parser.error('--appid is REQUIRED!')
+            if (self.args.appid is None and self.args.appids is None and
+                    self.args.appscopeid is None):
+                parser.error('--appid, --appids or --appscopeid is REQUIRED!')
         if self.args.action == "get_app_scope":
             if self.args.appscopeid is None:
                 if self.args.appscopeshortname is None:
@@ -909,10 +3310,26 @@ class Tetration(object):
                 if self.args.appscopeid is None:
                     parser.error(
                         '--appscopeid or --appscopeshortname is REQUIRED!')
+        if self.args.action == "create_inventory_filters":
+            if self.args.readcsv is None:
+                parser.error('--readcsv is REQUIRED!')
+        if self.args.action == "update_user_roles":
+            if self.args.readcsv is None:
+                parser.error('--readcsv is REQUIRED!')
+        if self.args.action == "get_inventory_filter":
+            if self.args.filterid is None and self.args.filtername is None:
+                parser.error('--filterid or --filtername is REQUIRED!')
         if self.args.action == "get_sensor":
             if self.args.hostname is None:
                 parser.error('--hostname is REQUIRED!')
-        if self.args.action == "remove_user_from_role":
+        if self.args.action == "get_user":
+            if (self.args.userfirstname is None or
+                    self.args.userlastname is None or
+                    self.args.useremail is None):
+                parser.error(
+                    '--userfirstname and --userlastname and '
+                    '--useremail ARE REQUIRED!')
+        if self.args.action in ("add_user_to_role", "remove_user_from_role"):
             if (self.args.userfirstname is None or
                     self.args.userlastname is None or
                     self.args.useremail is None or
@@ -920,6 +3337,36 @@ class Tetration(object):
                 parser.error(
                     '--userfirstname, --userlastname, --useremail, '
                     'and --userrole ARE REQUIRED!')
+        if self.args.action in NUMPY_ACTIONS and numpy is None:
+            parser.error('numpy is REQUIRED for %s! (pip install numpy)'
+                         % self.args.action)
+        if self.args.action == "match_sensor_subnets":
+            if self.args.subnets is None and self.args.subnetsfile is None:
+                parser.error('--subnets or --subnetsfile is REQUIRED!')
+        if self.args.action == "preview_app_scopes":
+            if self.args.readcsv is None:
+                parser.error('--readcsv is REQUIRED!')
+        if self.args.action == "query":
+            if self.args.queryname is None and self.args.sql is None:
+                parser.error('--queryname or --sql is REQUIRED!')
+            if self.args.queryname is not None:
+                arg_names = MIRROR_QUERIES[self.args.queryname][1]
+                if all(getattr(self.args, arg_name) is None
+                       for arg_name in arg_names):
+                    parser.error('%s is REQUIRED!' % ' or '.join(
+                        '--%s' % arg_name for arg_name in arg_names))
+        if self.args.action == "sync" and self.args.tables is not None:
+            unknown = [table.strip() for table in self.args.tables.split(',')
+                       if table.strip() and
+                       table.strip() not in MIRROR_TABLES]
+            if unknown:
+                parser.error('Unknown --tables %s! Use: %s'
+                             % (', '.join(unknown),
+                                ', '.join(sorted(MIRROR_TABLES))))
+        if self.args.clustersfile is not None:
+            if self.args.action not in FANOUT_ENDPOINTS:
+                parser.error('--clustersfile is only supported with: %s'
+                             % ', '.join(sorted(FANOUT_ENDPOINTS)))
         if self.args.credsfile is None:
             if self.args.apikey is None or self.args.apisecret is None:
                 parser.error('--apikey and --apisecret ARE REQUIRED!')
@@ -929,6 +3376,291 @@ class Tetration(object):
                     '--apikey and --apisecret ARE NOT REQUIRED when '
                     'using --credsfile!')
 
+    def iter_scope_ancestors(self, scope):
+        """Iterate the ancestors of scope, nearest first."""
+        by_id = self.get_scope_index()['by_id']
+        scope = by_id.get(scope.get('parent_app_scope_id'))
+        while scope is not None:
+            yield scope
+            scope = by_id.get(scope.get('parent_app_scope_id'))
+
+    def iter_scope_descendants(self, scope):
+        """Iterate scope and its descendants as (scope, depth) pairs."""
+        children = self.get_scope_index()['children']
+        stack = [(scope, 0)]
+        while stack:
+            scope, depth = stack.pop()
+            yield scope, depth
+            stack.extend((child, depth + 1) for child in
+                         reversed(children.get(scope['id'], [])))
+
+    def iter_sensors(self):
+        """
+        Iterate /sensors API records.
+
+        Pages are requested one at a time following the offset returned by
+        the API and are not kept in the request cache, so only one page of
+        raw records is held at once. Raises TetrationError when a page
+        cannot be fetched.
+        """
+        return iter_records(self.restclient, '/sensors', store=False)
+
+    def match_sensor_subnets(self):
+        """
+        Match Sensors To Subnets.
+
+        Reports the sensors with an interface in each of the CIDRs given
+        by --subnets or --subnetsfile (one CIDR per line).
+        """
+        if self.args.subnetsfile is not None:
+            with open(self.args.subnetsfile) as infile:
+                cidrs = [line.split(',')[0].strip() for line in infile
+                         if line.strip() and not line.startswith('#')]
+        else:
+            cidrs = [cidr.strip() for cidr in self.args.subnets.split(',')
+                     if cidr.strip()]
+        sensors = [sensor for sensor in self.get_sensor_index()['all']
+                   if sensor.deleted_at is None]
+        start = time.time()
+        ip_index = SensorIpIndex(sensors)
+        try:
+            matches = ip_index.match(cidrs)
+        except ValueError as err:
+            print colored('%s' % err, 'red')
+            return
+        sys.stderr.write('Matched %d subnets against %d interfaces of %d '
+                         'sensors in %.1fms\n'
+                         % (len(cidrs), len(ip_index.ips), len(sensors),
+                            (time.time() - start) * 1000))
+        python_data = dict(
+            (cidr, sorted(set(sensor.host_name for sensor in sensors)))
+            for cidr, sensors in zip(cidrs, matches))
+        self.output_results(python_data)
+
+    def preview_app_scopes(self):
+        """
+        Preview Application Scope Membership.
+
+        Evaluates the scopes in a create_app_scope CSV against a local
+        inventory snapshot (--inventoryfile, or the sensor inventory) and
+        reports how many items each would match, without creating them.
+        A scope matches the items matching both its query and its parent.
+        """
+        if self.args.inventoryfile is not None:
+            with open(self.args.inventoryfile) as infile:
+                python_data = json.load(infile)
+            if isinstance(python_data, dict):
+                python_data = python_data['results']
+            snapshot = InventorySnapshot.from_items(python_data)
+        else:
+            snapshot = InventorySnapshot.from_sensors(
+                self.get_sensor_index()['all'])
+        scope_masks = {}
+
+        def scope_mask(scope):
+            """Return the membership mask of an existing scope."""
+            if scope['id'] not in scope_masks:
+                mask = snapshot.evaluate(scope['short_query'])
+                parent = self.get_scope_index()['by_id'].get(
+                    scope.get('parent_app_scope_id'))
+                if parent is not None:
+                    mask &= scope_mask(parent)
+                scope_masks[scope['id']] = mask
+            return scope_masks[scope['id']]
+
+        candidate_masks = {}
+        start = time.time()
+        for chunk in self.read_csv_chunks():
+            for row in chunk:
+                query = {"type": row[2], "field": row[1], "value": row[3]}
+                try:
+                    if row[4] in candidate_masks:
+                        parent_mask = candidate_masks[row[4]]
+                    else:
+                        parent = self.find_app_scope(row[4])
+                        if parent is None:
+                            raise ValueError('Parent scope %s does not exist'
+                                             % row[4])
+                        parent_mask = scope_mask(parent)
+                    mask = snapshot.evaluate(query) & parent_mask
+                except ValueError as err:
+                    print colored('%s: %s' % (row[0], err), 'red')
+                    continue
+                candidate_masks[row[0]] = mask
+                print '%s (parent %s): %d of %d items' % (
+                    row[0], row[4], numpy.count_nonzero(mask), len(snapshot))
+        sys.stderr.write('Previewed %d scopes against %d items in %.1fms\n'
+                         % (len(candidate_masks), len(snapshot),
+                            (time.time() - start) * 1000))
+
+    def preflight(self):
+        """
+        Validate A Bulk CSV Before Any Mutation.
+
+        Every row of --readcsv is checked against the users, roles and
+        scopes indexes, which are fetched once, and all errors are reported
+        up front. With --onerror abort (the default) nothing is sent when
+        any row is invalid; with --onerror skip the invalid rows are
+        skipped. Returns whether the action should run.
+        """
+        validator = getattr(self, 'validate_%s_row' % self.args.action)
+        seen = set()
+        errors = []
+        line = 1
+        for chunk in self.read_csv_chunks():
+            for row in chunk:
+                line += 1
+                row_errors = validator(row, seen)
+                if row_errors:
+                    self.invalid_rows.add(line)
+                    errors.extend((line, error) for error in row_errors)
+        for line, error in errors:
+            print colored('%s line %d: %s' % (self.args.readcsv, line, error),
+                          'red')
+        if self.invalid_rows and self.args.onerror == 'abort':
+            print colored('%d invalid rows, nothing was changed. Fix them or '
+                          'use --onerror skip' % len(self.invalid_rows),
+                          'red')
+            return False
+        if self.invalid_rows:
+            print colored('Skipping %d invalid rows' % len(self.invalid_rows),
+                          'yellow')
+        return not self.args.validateonly
+
+    def read_app_clusters(self, path):
+        """
+        Read get_app_clusters output.
+
+        Accepts either the single application JSON document or the JSON
+        lines written for many applications and returns clusters keyed by
+        application id. The single application document does not name its
+        application, so --appid is required to read it.
+        """
+        with open(path) as infile:
+            content = infile.read()
+        try:
+            python_data = json.loads(content)
+        except ValueError:
+            python_data = None
+        if isinstance(python_data, dict) and 'Clusters' in python_data:
+            if self.args.appid is None:
+                raise TetrationError('%s holds a single application, '
+                                     '--appid is REQUIRED to diff it' % path)
+            return {self.args.appid: python_data['Clusters']}
+        apps = {}
+        for line in content.splitlines():
+            if line.strip():
+                python_data = json.loads(line)
+                apps[python_data['app_id']] = python_data['clusters']
+        return apps
+
+    def scope_error(self, name):
+        """Return why name does not resolve to one scope, or None."""
+        index = self.get_scope_index()
+        if (name in index['by_id'] or name in index['by_name'] or
+                name.replace('.', ':') in index['by_name']):
+            return None
+        scopes = index['by_short_name'].get(name, [])
+        if len(scopes) > 1:
+            return 'scope short name "%s" is ambiguous' % name
+        if not scopes:
+            return 'unknown scope "%s"' % name
+        return None
+
+    def validate_add_user_roles_row(self, row, seen):
+        """Return the errors of an add_user_roles CSV row."""
+        if len(row) < 4:
+            return ['expected 4 columns (role, description, scope, ability)']
+        errors = []
+        if not row[0].strip():
+            errors.append('role name is required')
+        if row[2]:
+            error = self.scope_error(row[2])
+            if error:
+                errors.append(error)
+            if row[3] and row[3] not in ROLE_ABILITIES:
+                errors.append('unknown ability "%s"' % row[3])
+        return errors
+
+    def validate_add_users_row(self, row, seen):
+        """Return the errors of an add_users CSV row."""
+        if len(row) < 3:
+            return ['expected at least 3 columns (email, first name, '
+                    'last name, roles)']
+        errors = self.validate_email(row[0], seen)
+        if not row[1].strip() or not row[2].strip():
+            errors.append('first and last name are required')
+        roles = self.get_role_index()['by_name']
+        for role in (row[3] if len(row) > 3 else '').split(','):
+            if role.strip() and role not in roles:
+                errors.append('unknown role "%s"' % role)
+        return errors
+
+    def validate_create_app_scope_row(self, row, seen):
+        """Return the errors of a create_app_scope CSV row."""
+        if len(row) < 5:
+            return ['expected 5 columns (short name, field, type, value, '
+                    'parent)']
+        errors = []
+        if not all(value.strip() for value in row[:4]):
+            errors.append('short name, field, type and value are required')
+        if row[4] not in seen:
+            error = self.scope_error(row[4])
+            if error:
+                errors.append('parent: %s' % error)
+        seen.add(row[0])
+        return errors
+
+    def validate_create_inventory_filters_row(self, row, seen):
+        """Return the errors of a create_inventory_filters CSV row."""
+        if len(row) < 5:
+            return ['expected at least 5 columns (name, field, type, value, '
+                    'app scope id, primary)']
+        errors = []
+        if not all(value.strip() for value in row[:4]):
+            errors.append('name, field, type and value are required')
+        if row[4] not in self.get_scope_index()['by_id']:
+            errors.append('unknown app scope id "%s"' % row[4])
+        if (row[4], row[0]) in seen:
+            errors.append('duplicate filter "%s" in scope %s'
+                          % (row[0], row[4]))
+        seen.add((row[4], row[0]))
+        return errors
+
+    def validate_delete_users_row(self, row, seen):
+        """Return the errors of a delete_users CSV row."""
+        if len(row) < 3:
+            return ['expected 3 columns (email, first name, last name)']
+        return self.validate_email(row[0], seen)
+
+    def validate_update_user_roles_row(self, row, seen):
+        """Return the errors of an update_user_roles CSV row."""
+        if len(row) < 3:
+            return ['expected 3 columns (email, role, add or remove)']
+        errors = []
+        email = row[0].strip().lower()
+        if email not in self.get_user_index()['by_email']:
+            errors.append('unknown user "%s"' % email)
+        if row[1].strip() not in self.get_role_index()['by_name']:
+            errors.append('unknown role "%s"' % row[1].strip())
+        if row[2].strip().lower() not in ('add', 'remove'):
+            errors.append('action must be add or remove, not "%s"' % row[2])
+        if (email, row[1].strip()) in seen:
+            errors.append('duplicate change for %s and role %s'
+                          % (email, row[1].strip()))
+        seen.add((email, row[1].strip()))
+        return errors
+
+    def validate_email(self, email, seen):
+        """Return the errors of a CSV email column."""
+        email = email.strip().lower()
+        if not email or '@' not in email:
+            return ['invalid email "%s"' % email]
+        if email in seen:
+            return ['duplicate email %s' % email]
+        seen.add(email)
+        return []
+
     def remove_user_from_role(self):
         """Remove A User From A role."""
         # NEED to add ability defined more than one role ####
@@ -953,6 +3685,699 @@ class Tetration(object):
                            'role: ', 'yellow')
                    + self.args.userrole)
 
+    def report_cache_stats(self):
+        """Report request cache hits and misses on stderr."""
+        if isinstance(getattr(self, 'restclient', None), CachingRestClient):
+            sys.stderr.write('Request cache: %d hits, %d misses\n'
+                             % (self.restclient.hits, self.restclient.misses))
+            disk_cache = self.restclient.restclient.restclient
+            if isinstance(disk_cache, DiskCachingRestClient):
+                sys.stderr.write(
+                    'Disk cache: %d hits, %d revalidated, %d misses\n'
+                    % (disk_cache.hits, disk_cache.revalidated,
+                       disk_cache.misses))
+
+    def report_failures(self):
+        """Report API retries, timeouts and failures on stderr."""
+        resilient = getattr(getattr(self, 'restclient', None), 'restclient',
+                            None)
+        if not isinstance(resilient, ResilientRestClient):
+            return
+        for collection, stats in sorted(resilient.stats.iteritems()):
+            if stats['requests'] == 0 or not any(
+                    stats[name] for name in ['retries', 'timeouts', 'failed',
+                                             'opened', 'rejected']):
+                continue
+            sys.stderr.write(
+                'API %s: %d requests, %d retries, %d timeouts, %d failed, '
+                'circuit opened %d times, %d rejected\n'
+                % (collection, stats['requests'], stats['retries'],
+                   stats['timeouts'], stats['failed'], stats['opened'],
+                   stats['rejected']))
+
+    def report_phases(self, elapsed):
+        """Report per-phase wall and CPU time and peak memory on stderr."""
+        sys.stderr.write('%-8s %8s %10s %10s\n'
+                         % ('Phase', 'Calls', 'Wall', 'CPU'))
+        for name in PROFILE_PHASES:
+            calls, wall, cpu = self.phases.totals.get(name, (0, 0.0, 0.0))
+            sys.stderr.write('%-8s %8d %9.3fs %9.3fs\n'
+                             % (name, calls, wall, cpu))
+        sys.stderr.write('%-8s %8s %9.3fs %9.3fs\n'
+                         % ('total', '', elapsed[0], elapsed[1]))
+        peak = peak_memory()
+        if peak is not None:
+            sys.stderr.write('Peak memory: %.1f MB\n' % (peak / 1048576.0))
+        sys.stderr.write('Profile written to %s (python -m pstats %s)\n'
+                         % (self.args.profile, self.args.profile))
+
+    def open_journal(self):
+        """Return the completed row hashes and open --journal for append."""
+        completed = set()
+        journal = None
+        if self.args.journal is not None:
+            if os.path.exists(self.args.journal):
+                with open(self.args.journal) as infile:
+                    completed = set(line.strip() for line in infile)
+            journal = open(self.args.journal, 'a', 1)
+        return completed, journal
+
+    def row_hash(self, row):
+        """Return the journal hash of a CSV row for this action."""
+        return hashlib.sha1('\x1f'.join([self.args.action] + row)).hexdigest()
+
+    def run_pipeline(self, mutate):
+        """
+        Run a user CSV through the bulk pipeline.
+
+        Rows are parsed and validated ahead of the network stages, user and
+        role ids are resolved a chunk at a time against the indexes and the
+        mutate stage runs with --workers threads. Completed rows are
+        journaled like run_journaled.
+        """
+        completed, journal = self.open_journal()
+        users = self.get_user_index()
+        roles = self.get_role_index()
+
+        skipped = []
+
+        def parse():
+            """Pipeline source yielding chunks of rows not yet journaled."""
+            for chunk in self.read_csv_chunks():
+                rows = [(self.row_hash(row), row) for row in chunk]
+                skipped.extend(row_hash for row_hash, _row in rows
+                               if row_hash in completed)
+                yield [(row_hash, row) for row_hash, row in rows
+                       if row_hash not in completed]
+
+        def validate(chunk):
+            """Pipeline stage turning a chunk of valid rows into items."""
+            items = []
+            for row_hash, row in chunk:
+                if len(row) < 3 or '@' not in row[0]:
+                    print colored('Invalid row skipped: %s' % ','.join(row),
+                                  'red')
+                    continue
+                items.append({
+                    "hash": row_hash, "email": row[0].strip(),
+                    "first_name": row[1], "last_name": row[2],
+                    "roles": [role.strip() for role in
+                              (row[3] if len(row) > 3 else '').split(',')
+                              if role.strip()],
+                    "messages": [], "ok": False
+                })
+            return [items]
+
+        def resolve(items):
+            """Pipeline stage resolving user and role ids for a chunk."""
+            for item in items:
+                item['user'] = users['by_email'].get(item['email'].lower())
+                item['role_ids'] = []
+                for role in item['roles']:
+                    if role in roles['by_name']:
+                        item['role_ids'].append(roles['by_name'][role]['id'])
+                    else:
+                        item['messages'].append(
+                            ('Role does not exist and user not added to '
+                             'role: %s' % role, 'yellow'))
+            return items
+
+        def sink(item):
+            """Report an item and journal it when it completed."""
+            for message, color in item['messages']:
+                print colored(message, color)
+            if item['ok'] and journal is not None:
+                journal.write(item['hash'] + '\n')
+
+        def traced_mutate(item):
+            """Pipeline stage running mutate for an item as a CSV row span."""
+            with self.tracer.span(self.args.action, 'csv') as args:
+                args['row'] = item['email']
+                item = mutate(item)
+                args['completed'] = item['ok']
+            return [item]
+
+        pipeline = Pipeline([('validate', validate, 1),
+                             ('resolve', resolve, 1),
+                             ('mutate', traced_mutate, self.args.workers)])
+        try:
+            pipeline.run(parse(), sink)
+        finally:
+            if journal is not None:
+                journal.close()
+        if skipped:
+            print colored('Skipped %d rows already completed in journal %s'
+                          % (len(skipped), self.args.journal), 'yellow')
+
+    def run_journaled(self, func):
+        """
+        Run func against every --readcsv row.
+
+        When --journal is set a hash of each completed row is appended to
+        the journal, and rows already recorded there by an earlier run are
+        skipped without any API calls.
+        """
+        completed, journal = self.open_journal()
+        skipped = 0
+        try:
+            for chunk in self.read_csv_chunks():
+                for row in chunk:
+                    row_hash = self.row_hash(row)
+                    if row_hash in completed:
+                        skipped += 1
+                        continue
+                    with self.tracer.span(self.args.action, 'csv') as args:
+                        args['row'] = row[0] if row else ''
+                        done = func(row)
+                        args['completed'] = bool(done)
+                    if done and journal is not None:
+                        journal.write(row_hash + '\n')
+                        completed.add(row_hash)
+        finally:
+            if journal is not None:
+                journal.close()
+        if skipped:
+            print colored('Skipped %d rows already completed in journal %s'
+                          % (skipped, self.args.journal), 'yellow')
+
+    def open_mirror(self):
+        """Open the --dbfile mirror, creating its tables when missing."""
+        db = sqlite3.connect(os.path.expanduser(self.args.dbfile))
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        for table, (_endpoint, _id_field, fields) in MIRROR_TABLES.iteritems():
+            db.execute('CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY, '
+                       'hash TEXT, data TEXT, %s)'
+                       % (table, ', '.join('%s COLLATE NOCASE' % field
+                                           for field in fields)))
+            for field in fields:
+                db.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)'
+                           % (table, field, table, field))
+        db.executescript(MIRROR_SCHEMA)
+        return db
+
+    def query(self):
+        """
+        Query The Local Mirror.
+
+        Answers a --queryname lookup or a --sql statement from the --dbfile
+        mirror written by sync, without calling the API. The mirror is
+        opened read-only, so statements which write to it fail.
+        """
+        path = os.path.expanduser(self.args.dbfile)
+        if not os.path.exists(path):
+            print colored('Mirror %s not found, run sync first...' % path,
+                          'yellow')
+            return
+        db = sqlite3.connect(path)
+        start = time.time()
+        try:
+            db.execute('PRAGMA query_only = ON')
+            if self.args.sql is not None:
+                cursor = db.execute(self.args.sql)
+                columns = [column[0] for column in cursor.description or []]
+                python_data = [dict(zip(columns, row)) for row in cursor]
+            else:
+                sql, arg_names = MIRROR_QUERIES[self.args.queryname]
+                value = [getattr(self.args, arg_name) for arg_name in arg_names
+                         if getattr(self.args, arg_name) is not None][0]
+                python_data = [json.loads(row[0]) for row in
+                               db.execute(sql, {'value': value})]
+        except (sqlite3.Error, sqlite3.Warning) as err:
+            raise TetrationError('Query failed: %s' % err)
+        finally:
+            db.close()
+        sys.stderr.write('Query returned %d records in %.1fms\n'
+                         % (len(python_data), (time.time() - start) * 1000))
+        self.output_results(python_data)
+
+    def run_concurrent(self, func, items):
+        """
+        Run func against items concurrently.
+
+        Uses a pool of --workers threads and yields results as they
+        complete. When func raises or the results stop being consumed, the
+        items not yet started are dropped.
+        """
+        pool = ThreadPool(self.args.workers)
+        completed = False
+        try:
+            for result in pool.imap_unordered(func, items):
+                yield result
+            completed = True
+        finally:
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+    def sensor_stats(self):
+        """
+        Report Sensor Fleet Statistics.
+
+        Check-in times, creation times and categorical fields are collected
+        into typed arrays in one streaming pass over /sensors. Check-in and
+        agent age percentiles and histograms and platform, version and
+        agent type counts are then computed with numpy. --output table
+        prints a text report.
+        """
+        check_ins = array.array('d')
+        created = array.array('d')
+        categories = dict((field, {}) for field in SENSOR_STATS_FIELDS)
+        codes = dict((field, array.array('i'))
+                     for field in SENSOR_STATS_FIELDS)
+        start = time.time()
+        for key in self.iter_sensors():
+            if key.get('deleted_at') is not None:
+                continue
+            check_ins.append(key.get('last_config_fetch_at') or float('nan'))
+            created.append(key.get('created_at') or float('nan'))
+            for field in SENSOR_STATS_FIELDS:
+                values = categories[field]
+                codes[field].append(values.setdefault(
+                    key.get(field) or 'unknown', len(values)))
+        if not check_ins:
+            print colored('No sensors found...', 'yellow')
+            return
+        collected = time.time()
+        now = time.time()
+        python_data = {
+            "sensors": len(check_ins),
+            "check_in_age": age_stats(
+                now - numpy.frombuffer(check_ins, dtype=numpy.float64)),
+            "agent_age": age_stats(
+                now - numpy.frombuffer(created, dtype=numpy.float64))
+        }
+        for field in SENSOR_STATS_FIELDS:
+            counts = numpy.bincount(
+                numpy.frombuffer(codes[field], dtype=numpy.intc),
+                minlength=len(categories[field]))
+            values = sorted(categories[field], key=categories[field].get)
+            python_data[field] = [
+                {"value": values[i], "count": int(counts[i]),
+                 "percent": round(100.0 * counts[i] / len(check_ins), 1)}
+                for i in numpy.argsort(-counts, kind='mergesort')]
+        sys.stderr.write('Collected %d sensors in %.3fs, computed statistics '
+                         'in %.1fms\n'
+                         % (len(check_ins), collected - start,
+                            (time.time() - collected) * 1000))
+        if self.args.output == 'table' and not self.args.savetofile:
+            self.write_sensor_stats(python_data)
+        else:
+            self.output_results(python_data)
+
+    def write_sensor_stats(self, python_data):
+        """Print sensor_stats results as a text report."""
+        print 'Sensors: %d' % python_data['sensors']
+        for name, title in (('check_in_age', 'Check-in age'),
+                            ('agent_age', 'Agent age')):
+            stats = python_data[name]
+            print
+            print '%s (days): %s' % (title, '  '.join(
+                '%s %s' % (percentile, stats['percentiles_days'][percentile])
+                for percentile in ['p%d' % percentile for percentile in
+                                   SENSOR_STATS_PERCENTILES]
+                if percentile in stats.get('percentiles_days', {})))
+            for bucket in stats.get('histogram', []):
+                print '  %-10s %8d  %5.1f%%' % (
+                    bucket['bucket'], bucket['count'],
+                    100.0 * bucket['count'] / python_data['sensors'])
+            if stats['unknown']:
+                print '  %-10s %8d' % ('unknown', stats['unknown'])
+        for field in SENSOR_STATS_FIELDS:
+            print
+            print '%s:' % field
+            for key in python_data[field]:
+                print '  %-30s %8d  %5.1f%%' % (key['value'], key['count'],
+                                                key['percent'])
+
+    def sync(self):
+        """
+        Sync The Local Mirror.
+
+        Mirrors users, roles, scopes, applications, sensors, filters and
+        VRFs (or --tables) into the indexed SQLite file --dbfile for the
+        query action. Collections are fetched concurrently and only records
+        whose content changed since the last sync are rewritten.
+        """
+        if self.args.tables is not None:
+            tables = [table.strip() for table in self.args.tables.split(',')
+                      if table.strip()]
+        else:
+            tables = sorted(MIRROR_TABLES)
+
+        def fetch(table):
+            """GET every record of a mirrored collection."""
+            start = time.time()
+            endpoint = MIRROR_TABLES[table][0]
+            try:
+                if table == 'sensors':
+                    records = list(self.iter_sensors())
+                else:
+                    resp = self.restclient.get(endpoint)
+                    if resp.status_code != 200:
+                        raise TetrationError('GET %s returned status %s'
+                                             % (endpoint, resp.status_code))
+                    records = json.loads(resp.text)
+            except (TetrationError,
+                    requests.exceptions.RequestException) as err:
+                return table, None, err
+            return table, records, time.time() - start
+
+        db = self.open_mirror()
+        try:
+            for table, records, result in self.run_concurrent(fetch, tables):
+                if records is None:
+                    print colored('%s: %s' % (table, result), 'red')
+                    continue
+                counts = self.sync_table(db, table, records)
+                sys.stderr.write(
+                    '%s: %d records fetched in %.3fs, %d added, %d changed, '
+                    '%d removed\n' % (table, len(records), result,
+                                      counts['added'], counts['changed'],
+                                      counts['removed']))
+        finally:
+            db.close()
+
+    def sync_links(self, db, table, record_id, key):
+        """Rewrite the link table rows of a mirrored record."""
+        if table == 'users':
+            db.execute('DELETE FROM user_roles WHERE user_id = ?',
+                       (record_id,))
+            if key is not None:
+                db.executemany('INSERT INTO user_roles VALUES (?, ?)',
+                               [(record_id, role_id)
+                                for role_id in key.get('role_ids', [])])
+        elif table == 'sensors':
+            db.execute('DELETE FROM sensor_ips WHERE uuid = ?', (record_id,))
+            if key is not None:
+                db.executemany('INSERT INTO sensor_ips VALUES (?, ?, ?)',
+                               [(record_id, _int['ip'], _int.get('vrf_id'))
+                                for _int in key.get('interfaces', [])
+                                if _int.get('ip')])
+
+    def sync_table(self, db, table, records):
+        """
+        Apply fetched records to a mirror table.
+
+        Records are compared by a hash of their content so unchanged ones
+        are not rewritten, and records no longer returned are deleted.
+        Returns the added, changed and removed counts.
+        """
+        _endpoint, id_field, fields = MIRROR_TABLES[table]
+        known = dict(db.execute('SELECT id, hash FROM %s' % table))
+        counts = {'added': 0, 'changed': 0, 'removed': 0}
+        insert = ('INSERT OR REPLACE INTO %s (id, hash, data, %s) '
+                  'VALUES (?, ?, ?, %s)' % (table, ', '.join(fields),
+                                            ', '.join('?' * len(fields))))
+        with db:
+            for key in records:
+                record_id = unicode(key[id_field])
+                data = json.dumps(key, sort_keys=True)
+                digest = hashlib.sha1(data).hexdigest()
+                previous = known.pop(record_id, None)
+                if previous == digest:
+                    continue
+                counts['added' if previous is None else 'changed'] += 1
+                db.execute(insert, [record_id, digest, data] +
+                           [key.get(field) for field in fields])
+                self.sync_links(db, table, record_id, key)
+            for record_id in known:
+                db.execute('DELETE FROM %s WHERE id = ?' % table,
+                           (record_id,))
+                self.sync_links(db, table, record_id, None)
+            counts['removed'] = len(known)
+            db.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)',
+                       (table, time.time(), len(records)))
+        return counts
+
+    def update_user_roles(self):
+        """
+        Update User Role Memberships From CSV.
+
+        Rows of (email, role, add or remove) are resolved against the user
+        and role indexes, which are fetched once. Rows which would not
+        change anything are skipped and the add_role and remove_role calls
+        run concurrently with --workers threads. Completed rows are
+        journaled like run_journaled.
+        """
+        users = self.get_user_index()
+        roles = self.get_role_index()
+        completed, journal = self.open_journal()
+        changes = []
+        skipped = 0
+        unchanged = 0
+        for chunk in self.read_csv_chunks():
+            for row in chunk:
+                row_hash = self.row_hash(row)
+                if row_hash in completed:
+                    skipped += 1
+                    continue
+                user = users['by_email'][row[0].strip().lower()]
+                role = roles['by_name'][row[1].strip()]
+                add = row[2].strip().lower() == 'add'
+                if (role['id'] in user.get('role_ids', [])) == add:
+                    unchanged += 1
+                    continue
+                changes.append((row_hash, user, role, add))
+
+        def update(change):
+            """
+            PUT add_role or DELETE remove_role for a single change.
+
+            Returns the change and None, or the reason it failed.
+            """
+            _row_hash, user, role, add = change
+            endpoint = '/users/%s/%s' % (user['id'],
+                                         'add_role' if add else 'remove_role')
+            req_payload = json.dumps({"role_id": role['id']})
+            with self.tracer.span(self.args.action, 'csv') as args:
+                args['row'] = user['email']
+                try:
+                    if add:
+                        resp = self.restclient.put(endpoint,
+                                                   json_body=req_payload)
+                    else:
+                        resp = self.restclient.delete(endpoint,
+                                                      json_body=req_payload)
+                except (TetrationError,
+                        requests.exceptions.RequestException) as err:
+                    args['completed'] = False
+                    return change, '%s' % err
+                args['completed'] = resp.status_code == 200
+            if resp.status_code != 200:
+                return change, 'status %s' % resp.status_code
+            return change, None
+
+        failed = 0
+        try:
+            for change, error in self.run_concurrent(update, changes):
+                row_hash, user, role, add = change
+                if error is not None:
+                    failed += 1
+                    print colored('User %s: %s role %s failed with %s'
+                                  % (user['email'],
+                                     'adding' if add else 'removing',
+                                     role['name'], error), 'red')
+                    continue
+                role_ids = user.setdefault('role_ids', [])
+                if add:
+                    role_ids.append(role['id'])
+                    print colored('User %s added to role %s'
+                                  % (user['email'], role['name']), 'yellow')
+                else:
+                    role_ids.remove(role['id'])
+                    print colored('User %s removed from role %s'
+                                  % (user['email'], role['name']), 'yellow')
+                if journal is not None:
+                    journal.write(row_hash + '\n')
+        finally:
+            if journal is not None:
+                journal.close()
+        print colored('%d memberships changed, %d failed, %d already up to '
+                      'date' % (len(changes) - failed, failed, unchanged),
+                      'yellow')
+        if skipped:
+            print colored('Skipped %d rows already completed in journal %s'
+                          % (skipped, self.args.journal), 'yellow')
+
+    def watch(self):
+        """
+        Watch Sensors For Changes.
+
+        Polls /sensors every --interval seconds over the pooled client
+        connection and writes one JSON line per added, removed or changed
+        sensor. Sensors are compared by a fingerprint of their record, so
+        nothing is written when nothing changed. Runs until interrupted or
+        for --polls polls.
+        """
+        known = None
+        polls = 0
+        try:
+            while True:
+                start = time.time()
+                self.restclient.invalidate('/sensors')
+                current = {}
+                try:
+                    for key in self.iter_sensors():
+                        current[key['uuid']] = (sensor_fingerprint(key),
+                                                key.get('host_name'))
+                except TetrationError as err:
+                    sys.stderr.write('Poll skipped: %s\n' % err)
+                    current = None
+                if current is not None and known is None:
+                    sys.stderr.write('Watching %d sensors\n' % len(current))
+                elif current is not None:
+                    self.write_watch_events(known, current)
+                if current is not None:
+                    known = current
+                polls += 1
+                if self.args.polls and polls >= self.args.polls:
+                    return
+                time.sleep(max(0, self.args.interval -
+                               (time.time() - start)))
+        except KeyboardInterrupt:
+            return
+
+    def write_watch_events(self, known, current):
+        """Write change events between two sensor fingerprint maps."""
+        now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        events = []
+        for uuid, (fingerprint, host_name) in current.iteritems():
+            if uuid not in known:
+                events.append(('added', uuid, host_name))
+            elif known[uuid][0] != fingerprint:
+                events.append(('changed', uuid, host_name))
+        for uuid, (_fingerprint, host_name) in known.iteritems():
+            if uuid not in current:
+                events.append(('removed', uuid, host_name))
+        for event, uuid, host_name in events:
+            sys.stdout.write(json.dumps({"time": now, "event": event,
+                                         "uuid": uuid,
+                                         "host_name": host_name}) + '\n')
+        if events:
+            sys.stdout.flush()
+
+    def output_results(self, python_data):
+        """
+        Output Results.
+
+        Results are saved to --savetofile when given. Otherwise they are
+        streamed to stdout a record at a time in the --output format: a
+        JSON document (indented on a terminal), JSON lines, CSV or a
+        compact table.
+        """
+        if self.args.savetofile:
+            if not isinstance(python_data, (dict, list)):
+                python_data = list(python_data)
+            self.save_results(python_data)
+            return
+        output = self.args.output
+        try:
+            with self.phases.phase('output'):
+                if output == 'csv':
+                    self.write_csv(python_data)
+                elif output == 'table':
+                    self.write_table(python_data)
+                elif output == 'ndjson':
+                    self.write_ndjson(python_data)
+                else:
+                    self.write_json(python_data)
+                sys.stdout.flush()
+        except IOError as err:
+            if err.errno != errno.EPIPE:
+                raise
+            # The reader went away (e.g. piped to head), drop buffered output.
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+
+    def write_json(self, python_data):
+        """Write results to stdout as a JSON document."""
+        indent = 4 if sys.stdout.isatty() else None
+        if isinstance(python_data, dict):
+            sys.stdout.write(json.dumps(python_data, indent=indent) + '\n')
+            return
+        padding = ' ' * (indent or 0)
+        separators = (',', ': ') if indent else None
+        separator = '\n'
+        sys.stdout.write('[')
+        for key in python_data:
+            text = json.dumps(key, indent=indent, separators=separators)
+            sys.stdout.write(separator + padding +
+                             text.replace('\n', '\n' + padding))
+            separator = ',\n'
+        if separator != '\n':
+            sys.stdout.write('\n')
+        sys.stdout.write(']\n')
+
+    def write_ndjson(self, python_data):
+        """Write results to stdout as one JSON record per line."""
+        if isinstance(python_data, dict):
+            python_data = [python_data]
+        for key in python_data:
+            sys.stdout.write(json.dumps(key) + '\n')
+
+    def result_columns(self, record):
+        """Return --columns or the scalar fields of a record."""
+        if self.args.columns is not None:
+            return [column.strip() for column in
+                    self.args.columns.split(',') if column.strip()]
+        return sorted(field for field, value in record.iteritems()
+                      if not isinstance(value, (dict, list)))
+
+    def write_csv(self, python_data):
+        """
+        Write results to stdout as CSV.
+
+        Columns are chosen like write_table, and list and dict values are
+        written as compact JSON.
+        """
+        records = iter(result_records(python_data))
+        first = next(records, None)
+        if first is None:
+            return
+        columns = self.result_columns(first)
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+        for key in itertools.chain([first], records):
+            writer.writerow([cell.encode('utf-8')
+                             if isinstance(cell, unicode) else cell
+                             for cell in [table_cell(key.get(column))
+                                          for column in columns]])
+
+    def write_table(self, python_data):
+        """
+        Write results to stdout as a compact table.
+
+        Columns are --columns or the scalar fields of the first record, and
+        are sized from the first TABLE_SAMPLE_ROWS records so the rest can
+        be streamed. A dict of results is shown as key and value rows.
+        """
+        records = iter(result_records(python_data))
+        sample = list(itertools.islice(records, TABLE_SAMPLE_ROWS))
+        if not sample:
+            return
+        columns = self.result_columns(sample[0])
+        widths = [min(max([len(column)] +
+                          [len(table_cell(key.get(column)))
+                           for key in sample]), TABLE_MAX_WIDTH)
+                  for column in columns]
+
+        def write_row(cells):
+            """Write one padded table row."""
+            line = '  '.join(
+                (cell if len(cell) <= width else cell[:width - 1] + '~')
+                .ljust(width) for cell, width in zip(cells, widths))
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+            sys.stdout.write(line.rstrip() + '\n')
+
+        write_row(columns)
+        write_row(['-' * width for width in widths])
+        for key in itertools.chain(sample, records):
+            write_row([table_cell(key.get(column)) for column in columns])
+
     def save_results(self, python_data):
         """Save scan results to file specified in JSON format."""
         with open(self.args.savetofile, 'w') as outfile: